@@ -0,0 +1,137 @@
+import argparse
+import random
+import timeit
+from unittest import mock
+
+import s3_tagger
+
+
+def split_and_probe(key, csv_data):
+    # The key resolution tag_object used before layout rules were compiled
+    split_string = key.split("/")
+    table_name = ""
+    db_name = ""
+
+    if len(split_string) < 3:
+        return None
+
+    if split_string[-1].endswith("_$folder$"):
+        split_string[-1] = split_string[-1][0:-9]
+
+    substring_in_list = any(".db" in item for item in split_string)
+
+    if substring_in_list:
+        for index, value in enumerate(split_string):
+            split_string[index] = (
+                value.replace(".db", "") if value.endswith(".db") else value
+            )
+
+    try:
+        if split_string[-2] in csv_data:
+            db_name = split_string[-2]
+            table_name = split_string[-1]
+        elif split_string[-3] in csv_data:
+            db_name = split_string[-3]
+            table_name = split_string[-2]
+        elif split_string[-4] in csv_data:
+            db_name = split_string[-4]
+            table_name = split_string[-3]
+        else:
+            return None
+    except Exception:
+        return None
+
+    pii_value = ""
+    for table in csv_data[db_name]:
+        if table_name == table["table"]:
+            pii_value = table["pii"]
+
+    return db_name, table_name, pii_value
+
+
+def generate_csv_data(number_of_dbs, tables_per_db):
+    return {
+        f"db{db_index}": [
+            {"table": f"tab{table_index}", "pii": random.choice(["true", "false", ""])}
+            for table_index in range(tables_per_db)
+        ]
+        for db_index in range(number_of_dbs)
+    }
+
+
+def generate_keys(csv_data, number_of_keys):
+    layouts = [
+        "data/2021-01-28/{db}.db/{table}/part-{part:05d}",
+        "data/2021-01-28/{db}.db/{table}_$folder$",
+        "data/2021-01-28/{db}/{table}/partition{part}/part-{part:05d}",
+        "data/2021-01-28/{db}.db/{table}/dt=2021-01-01/part-{part:05d}",
+    ]
+    keys = []
+    db_names = list(csv_data)
+    for part in range(number_of_keys):
+        db_name = random.choice(db_names)
+        table_name = random.choice(csv_data[db_name])["table"]
+        keys.append(
+            random.choice(layouts).format(db=db_name, table=table_name, part=part)
+        )
+    return keys
+
+
+def resolve_all_split_and_probe(keys, csv_data):
+    for key in keys:
+        split_and_probe(key, csv_data)
+
+
+def resolve_all_key_layout(keys, csv_data, key_layout):
+    for key in keys:
+        s3_tagger.resolve_tags(key, csv_data, key_layout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares compiled key layout rules with the old split-and-probe key resolution"
+    )
+    parser.add_argument("--number-of-keys", type=int, default=100000)
+    parser.add_argument("--number-of-dbs", type=int, default=20)
+    parser.add_argument("--tables-per-db", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    s3_tagger.logger = mock.MagicMock()
+    random.seed(0)
+    csv_data = generate_csv_data(args.number_of_dbs, args.tables_per_db)
+    keys = generate_keys(csv_data, args.number_of_keys)
+
+    compile_time = min(
+        timeit.repeat(lambda: s3_tagger.KeyLayout(csv_data), number=1, repeat=3)
+    )
+    key_layout = s3_tagger.KeyLayout(csv_data)
+
+    split_and_probe_time = min(
+        timeit.repeat(
+            lambda: resolve_all_split_and_probe(keys, csv_data),
+            number=1,
+            repeat=args.repeat,
+        )
+    )
+    key_layout_time = min(
+        timeit.repeat(
+            lambda: resolve_all_key_layout(keys, csv_data, key_layout),
+            number=1,
+            repeat=args.repeat,
+        )
+    )
+
+    print(
+        f"keys: {len(keys)}, dbs: {len(csv_data)}, tables per db: {args.tables_per_db}"
+    )
+    print(f"key layout compile: {compile_time * 1000:.2f} ms")
+    print(
+        f"split and probe: {split_and_probe_time:.3f} s "
+        f"({len(keys) / split_and_probe_time:,.0f} keys/s)"
+    )
+    print(
+        f"compiled key layout: {key_layout_time:.3f} s "
+        f"({len(keys) / key_layout_time:,.0f} keys/s)"
+    )
+    print(f"speedup: {split_and_probe_time / key_layout_time:.2f}x")
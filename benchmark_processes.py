@@ -0,0 +1,72 @@
+import argparse
+import os
+import resource
+import tempfile
+
+import fake_s3
+import load_test
+
+
+def child_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(args, processes):
+    args.tagger_args = ["--processes", str(processes)] + args.extra_tagger_args
+    work_dir = tempfile.mkdtemp(prefix=f"s3_tagger_processes_{processes}_")
+    server_process, endpoint_url = load_test.start_fake_s3(args)
+    try:
+        cpu_before = child_cpu_seconds()
+        return_code, elapsed, log_file_name = load_test.run_tagger(
+            args, endpoint_url, work_dir
+        )
+        # Includes the tagging processes, which the tagger waits for
+        tagger_cpu = child_cpu_seconds() - cpu_before
+    finally:
+        server_process.terminate()
+
+    if return_code != 0:
+        raise RuntimeError(f"s3_tagger.py failed, see {log_file_name}")
+
+    tagged_count = load_test.read_tagged_count(log_file_name)
+    return tagged_count, elapsed, tagger_cpu
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tags the same fake S3 objects with an increasing number of "
+        "--processes and reports how throughput scales. Arguments after -- are "
+        "passed to s3_tagger.py"
+    )
+    fake_s3.add_arguments(parser)
+    parser.set_defaults(
+        tagging_latency_p50=0.0,
+        tagging_latency_p99=0.0,
+        list_latency_p50=0.0,
+        list_latency_p99=0.0,
+    )
+    parser.add_argument("--data-s3-prefix", default="data/")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("extra_tagger_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    args.log_level = "INFO"
+    if args.extra_tagger_args[:1] == ["--"]:
+        args.extra_tagger_args = args.extra_tagger_args[1:]
+
+    print(f"cpus: {os.cpu_count()}")
+    if os.cpu_count() < max(args.processes) + 1:
+        print(
+            "warning: fewer cpus than the most processes plus one for the fake S3, "
+            "so these runs cannot show scaling across cores"
+        )
+    baseline = None
+    for processes in args.processes:
+        tagged_count, elapsed, tagger_cpu = run(args, processes)
+        objects_per_second = tagged_count / elapsed
+        baseline = baseline or objects_per_second
+        print(
+            f"processes: {processes}, tagged: {tagged_count}, elapsed: {elapsed:.2f} s, "
+            f"{objects_per_second:,.0f} objects/s, speedup: {objects_per_second / baseline:.2f}x, "
+            f"tagger cpu: {tagger_cpu * 1000 / max(tagged_count, 1):.2f} ms/object"
+        )
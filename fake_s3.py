@@ -0,0 +1,454 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+LAST_MODIFIED = "2021-01-28T00:00:00.000Z"
+
+KEY_LAYOUTS = {
+    "flat": "data/db{db:03d}.db/tab{table:04d}/part-{part:05d}",
+    "partitioned": "data/db{db:03d}.db/tab{table:04d}/partition{partition:03d}/part-{part:05d}",
+    "hive": "data/db{db:03d}.db/tab{table:04d}/dt={partition:04d}/part-{part:05d}",
+}
+
+OPERATIONS = [
+    "list_objects_v2",
+    "put_object_tagging",
+    "get_object_tagging",
+    "get_object",
+    "put_object",
+]
+
+
+class SyntheticKeys:
+    # Every field is zero padded and appears in db, table, partition, part
+    # order, so key(index) sorts the same way as index and a prefix can be
+    # found by bisecting the index range instead of holding millions of keys
+    def __init__(self, layout, dbs, tables_per_db, partitions_per_table, parts):
+        self.template = KEY_LAYOUTS.get(layout, layout)
+        self.dbs = dbs
+        self.tables_per_db = tables_per_db
+        self.partitions_per_table = (
+            partitions_per_table if "{partition" in self.template else 1
+        )
+        self.parts = parts
+        self.count = dbs * tables_per_db * self.partitions_per_table * parts
+
+    def key(self, index):
+        index, part = divmod(index, self.parts)
+        index, partition = divmod(index, self.partitions_per_table)
+        db, table = divmod(index, self.tables_per_db)
+        return self.template.format(db=db, table=table, partition=partition, part=part)
+
+    def first_index_at_or_after(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def csv_rows(self, seed=0):
+        pii_random = random.Random(seed)
+        for db in range(self.dbs):
+            for table in range(self.tables_per_db):
+                yield (
+                    f"db{db:03d}",
+                    f"tab{table:04d}",
+                    pii_random.choice(["true", "false", ""]),
+                )
+
+
+class FaultProfile:
+    def __init__(
+        self, latency_p50=0.0, latency_p99=0.0, throttle_rate=0.0, error_rate=0.0
+    ):
+        self.latency_p50 = latency_p50
+        self.latency_p99 = latency_p99
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+
+    def latency(self):
+        if self.latency_p50 <= 0:
+            return 0.0
+        if self.latency_p99 <= self.latency_p50:
+            return self.latency_p50
+
+        # Log-normal latency with the requested median and 99th percentile
+        sigma = math.log(self.latency_p99 / self.latency_p50) / 2.3263
+        return random.lognormvariate(math.log(self.latency_p50), sigma)
+
+    def fault(self):
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 503, "SlowDown", "Please reduce your request rate."
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, "InternalError", "We encountered an internal error."
+        return None
+
+
+class FakeS3State:
+    def __init__(
+        self, data_bucket, synthetic_keys, fault_profiles, files=None, store_tags=True
+    ):
+        self.data_bucket = data_bucket
+        self.synthetic_keys = synthetic_keys
+        self.fault_profiles = fault_profiles
+        self.files = files or {}
+        self.store_tags = store_tags
+        self.tags = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            operation: {
+                "requests": 0,
+                "throttled": 0,
+                "errors": 0,
+                "latency_seconds": 0.0,
+            }
+            for operation in OPERATIONS
+        }
+
+    def record(self, operation, latency, fault):
+        with self.lock:
+            stats = self.stats[operation]
+            stats["requests"] += 1
+            stats["latency_seconds"] += latency
+            if fault is not None and fault[0] == 503:
+                stats["throttled"] += 1
+            elif fault is not None:
+                stats["errors"] += 1
+
+    def stats_summary(self):
+        with self.lock:
+            summary = {}
+            for operation, stats in self.stats.items():
+                summary[operation] = dict(stats)
+                summary[operation]["retries"] = stats["throttled"] + stats["errors"]
+            summary["objects"] = self.synthetic_keys.count
+            summary["objects_with_tags"] = len(self.tags)
+            return summary
+
+
+class FakeS3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+        body = b""
+        if "Content-Length" in self.headers:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        return bucket, key, query, body
+
+    def _send(self, status, body=b"", headers=None, send_body=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_xml(self, status, xml):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n' + xml).encode()
+        self._send(status, body, {"Content-Type": "application/xml"})
+
+    def _send_error(self, status, code, message):
+        self._send_xml(
+            status,
+            f"<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>",
+        )
+
+    def _handle_with_faults(self, operation, handler, *handler_args):
+        state = self.server.state
+        fault_profile = state.fault_profiles.get(operation, FaultProfile())
+        latency = fault_profile.latency()
+        fault = fault_profile.fault()
+        state.record(operation, latency, fault)
+
+        if latency > 0:
+            time.sleep(latency)
+        if fault is not None:
+            self._send_error(*fault)
+        else:
+            handler(*handler_args)
+
+    def do_GET(self):
+        bucket, key, query, _ = self._parse_request()
+        if bucket == "_fake_s3" and key == "stats":
+            body = json.dumps(self.server.state.stats_summary()).encode()
+            self._send(200, body, {"Content-Type": "application/json"})
+        elif not key:
+            self._handle_with_faults(
+                "list_objects_v2", self._list_objects_v2, bucket, query
+            )
+        elif "tagging" in query:
+            self._handle_with_faults(
+                "get_object_tagging", self._get_object_tagging, bucket, key
+            )
+        else:
+            self._handle_with_faults("get_object", self._get_object, bucket, key)
+
+    def do_HEAD(self):
+        bucket, key, _, _ = self._parse_request()
+        self._get_object(bucket, key, send_body=False)
+
+    def do_PUT(self):
+        bucket, key, query, body = self._parse_request()
+        if "tagging" in query:
+            self._handle_with_faults(
+                "put_object_tagging", self._put_object_tagging, bucket, key, body
+            )
+        else:
+            self._handle_with_faults("put_object", self._put_object, bucket, key, body)
+
+    def _object_exists(self, bucket, key):
+        state = self.server.state
+        if (bucket, key) in state.files:
+            return True
+        if bucket != state.data_bucket:
+            return False
+        synthetic_keys = state.synthetic_keys
+        index = synthetic_keys.first_index_at_or_after(key)
+        return index < synthetic_keys.count and synthetic_keys.key(index) == key
+
+    def _list_objects_v2(self, bucket, query):
+        state = self.server.state
+        if bucket != state.data_bucket:
+            self._send_error(404, "NoSuchBucket", "The bucket does not exist")
+            return
+
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [""])[0]
+        max_keys = int(query.get("max-keys", ["1000"])[0])
+        synthetic_keys = state.synthetic_keys
+
+        if "continuation-token" in query:
+            index = int(query["continuation-token"][0])
+        else:
+            start_after = query.get("start-after", [""])[0]
+            index = synthetic_keys.first_index_at_or_after(max(prefix, start_after))
+            if (
+                index < synthetic_keys.count
+                and synthetic_keys.key(index) == start_after
+            ):
+                index += 1
+
+        contents = []
+        common_prefixes = []
+        while (
+            index < synthetic_keys.count
+            and len(contents) + len(common_prefixes) < max_keys
+        ):
+            key = synthetic_keys.key(index)
+            if not key.startswith(prefix):
+                break
+
+            delimiter_index = key.find(delimiter, len(prefix)) if delimiter else -1
+            if delimiter_index >= 0:
+                common_prefix = key[: delimiter_index + len(delimiter)]
+                common_prefixes.append(
+                    f"<CommonPrefixes><Prefix>{escape(common_prefix)}</Prefix></CommonPrefixes>"
+                )
+                # Skip every key under the common prefix in one bisection
+                index = synthetic_keys.first_index_at_or_after(
+                    common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1)
+                )
+                continue
+
+            contents.append(
+                f"<Contents><Key>{escape(key)}</Key><LastModified>{LAST_MODIFIED}</LastModified>"
+                f"<ETag>&quot;{index:032x}&quot;</ETag><Size>1024</Size>"
+                f"<StorageClass>STANDARD</StorageClass></Contents>"
+            )
+            index += 1
+
+        is_truncated = index < synthetic_keys.count and synthetic_keys.key(
+            index
+        ).startswith(prefix)
+        next_token = (
+            f"<NextContinuationToken>{index}</NextContinuationToken>"
+            if is_truncated
+            else ""
+        )
+        self._send_xml(
+            200,
+            f'<ListBucketResult xmlns="{S3_NAMESPACE}"><Name>{escape(bucket)}</Name>'
+            f"<Prefix>{escape(prefix)}</Prefix><Delimiter>{escape(delimiter)}</Delimiter>"
+            f"<KeyCount>{len(contents) + len(common_prefixes)}</KeyCount>"
+            f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(is_truncated).lower()}</IsTruncated>"
+            f"{next_token}{''.join(contents)}{''.join(common_prefixes)}</ListBucketResult>",
+        )
+
+    def _put_object(self, bucket, key, body):
+        state = self.server.state
+        with state.lock:
+            state.files[(bucket, key)] = body
+        self._send(200, headers={"ETag": '"fake"'})
+
+    def _put_object_tagging(self, bucket, key, body):
+        state = self.server.state
+        if not self._object_exists(bucket, key):
+            self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+            return
+
+        if state.store_tags:
+            with state.lock:
+                state.tags[(bucket, key)] = body
+        self._send(200)
+
+    def _get_object_tagging(self, bucket, key):
+        state = self.server.state
+        if not self._object_exists(bucket, key):
+            self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+            return
+
+        with state.lock:
+            body = state.tags.get((bucket, key))
+        if body is None:
+            body = (
+                f'<Tagging xmlns="{S3_NAMESPACE}"><TagSet></TagSet></Tagging>'.encode()
+            )
+        self._send(200, body, {"Content-Type": "application/xml"})
+
+    def _get_object(self, bucket, key, send_body=True):
+        state = self.server.state
+        if (bucket, key) in state.files:
+            body = state.files[(bucket, key)]
+        elif self._object_exists(bucket, key):
+            body = b"x" * 1024
+        elif send_body:
+            self._send_error(404, "NoSuchKey", "The specified key does not exist.")
+            return
+        else:
+            self._send(404, send_body=False)
+            return
+
+        headers = {
+            "Content-Type": "binary/octet-stream",
+            "ETag": '"fake"',
+            "Last-Modified": "Thu, 28 Jan 2021 00:00:00 GMT",
+        }
+        self._send(200, body, headers, send_body)
+
+
+def create_server(state, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), FakeS3RequestHandler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def build_csv(synthetic_keys, seed=0, changed_tables=0):
+    lines = ["db,table,pii"]
+    for index, (db_name, table_name, pii_value) in enumerate(
+        synthetic_keys.csv_rows(seed)
+    ):
+        if index < changed_tables:
+            pii_value = "false" if pii_value == "true" else "true"
+        lines.append(f"{db_name},{table_name},{pii_value}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def add_arguments(parser):
+    parser.add_argument("--data-bucket", default="fake-data-bucket")
+    parser.add_argument("--csv-bucket", default="fake-csv-bucket")
+    parser.add_argument("--csv-key", default="table_info.csv")
+    parser.add_argument(
+        "--key-layout",
+        default="partitioned",
+        help=f"One of {', '.join(KEY_LAYOUTS)} or a key template with zero padded "
+        "{db}, {table}, {partition} and {part} fields in that order",
+    )
+    parser.add_argument("--dbs", type=int, default=10)
+    parser.add_argument("--tables-per-db", type=int, default=10)
+    parser.add_argument("--partitions-per-table", type=int, default=10)
+    parser.add_argument("--parts", type=int, default=10)
+    parser.add_argument(
+        "--tagging-latency-p50", type=float, default=0.01, help="Seconds"
+    )
+    parser.add_argument(
+        "--tagging-latency-p99", type=float, default=0.05, help="Seconds"
+    )
+    parser.add_argument("--list-latency-p50", type=float, default=0.02, help="Seconds")
+    parser.add_argument("--list-latency-p99", type=float, default=0.1, help="Seconds")
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of tagging requests answered with 503 SlowDown",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of tagging requests answered with 500 InternalError",
+    )
+    parser.add_argument(
+        "--store-tags",
+        action="store_true",
+        help="Keep the tags written so get_object_tagging returns them",
+    )
+    parser.add_argument(
+        "--snapshot-changed-tables",
+        type=int,
+        help="Also serve a CSV snapshot, for --delta runs, in which the pii value "
+        "of this many tables differs from the CSV",
+    )
+
+
+def state_from_args(args):
+    synthetic_keys = SyntheticKeys(
+        args.key_layout,
+        args.dbs,
+        args.tables_per_db,
+        args.partitions_per_table,
+        args.parts,
+    )
+    tagging_profile = FaultProfile(
+        args.tagging_latency_p50,
+        args.tagging_latency_p99,
+        args.throttle_rate,
+        args.error_rate,
+    )
+    fault_profiles = {
+        "list_objects_v2": FaultProfile(args.list_latency_p50, args.list_latency_p99),
+        "put_object_tagging": tagging_profile,
+        "get_object_tagging": tagging_profile,
+    }
+    files = {(args.csv_bucket, args.csv_key): build_csv(synthetic_keys)}
+    if args.snapshot_changed_tables is not None:
+        files[(args.csv_bucket, f"{args.csv_key}.snapshot")] = build_csv(
+            synthetic_keys, changed_tables=args.snapshot_changed_tables
+        )
+    return FakeS3State(
+        args.data_bucket, synthetic_keys, fault_profiles, files, args.store_tags
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="A local S3 stand-in serving synthetic objects with injected latency and faults"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(state_from_args(args), args.host, args.port)
+    print(
+        f"Serving {server.server_address} with {server.state.synthetic_keys.count} objects"
+    )
+    server.serve_forever()
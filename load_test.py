@@ -0,0 +1,142 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_s3
+
+TAGGER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "s3_tagger.py")
+
+
+def serve_fake_s3(args, port_queue):
+    server = fake_s3.create_server(fake_s3.state_from_args(args))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_s3(args):
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=serve_fake_s3, args=(args, port_queue), daemon=True
+    )
+    server_process.start()
+    return server_process, f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+
+def get_fake_s3_stats(endpoint_url):
+    with urllib.request.urlopen(f"{endpoint_url}/_fake_s3/stats") as response:
+        return json.loads(response.read())
+
+
+def run_tagger(args, endpoint_url, work_dir):
+    command = [
+        sys.executable,
+        TAGGER_PATH,
+        "--csv-location",
+        f"s3://{args.csv_bucket}/{args.csv_key}",
+        "--data-bucket",
+        args.data_bucket,
+        "--data-s3-prefix",
+        args.data_s3_prefix,
+        "--s3-endpoint-url",
+        endpoint_url,
+        "--log-level",
+        args.log_level,
+    ]
+    if args.snapshot_changed_tables is not None:
+        # The fake S3 serves the snapshot next to the CSV
+        command += [
+            "--csv-snapshot-location",
+            f"s3://{args.csv_bucket}/{args.csv_key}.snapshot",
+        ]
+    command += args.tagger_args
+    environment = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID="fake",
+        AWS_SECRET_ACCESS_KEY="fake",
+        AWS_DEFAULT_REGION="eu-west-2",
+    )
+
+    os.makedirs(work_dir, exist_ok=True)
+    log_file_name = os.path.join(work_dir, "s3_tagger.log")
+    with open(log_file_name, "w") as log_file:
+        start = time.monotonic()
+        completed = subprocess.run(
+            command,
+            cwd=work_dir,
+            env=environment,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        elapsed = time.monotonic() - start
+
+    return completed.returncode, elapsed, log_file_name
+
+
+def read_tagged_count(log_file_name):
+    tagged_count = 0
+    with open(log_file_name) as log_file:
+        for line in log_file:
+            match = re.search('"objects_tagged_count": "([0-9]+)', line)
+            if match:
+                tagged_count = int(match.group(1))
+    return tagged_count
+
+
+def report(args, return_code, elapsed, log_file_name, stats):
+    tagging_stats = stats["put_object_tagging"]
+    successful_tagging_requests = tagging_stats["requests"] - tagging_stats["retries"]
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    results = {
+        "return_code": return_code,
+        "objects": stats["objects"],
+        "objects_tagged_count": read_tagged_count(log_file_name),
+        "elapsed_seconds": round(elapsed, 2),
+        "objects_per_second": round(successful_tagging_requests / elapsed, 1),
+        "tagger_peak_rss_mb": round(peak_rss_mb, 1),
+        "requests": {
+            operation: stats[operation]
+            for operation in fake_s3.OPERATIONS
+            if stats[operation]["requests"]
+        },
+        "log_file": log_file_name,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs s3_tagger.py end to end against a local fake S3 and reports "
+        "throughput, memory and retries. Arguments after -- are passed to s3_tagger.py"
+    )
+    fake_s3.add_arguments(parser)
+    parser.add_argument("--data-s3-prefix", default="data/")
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        help="The tagged count is read from the tagger log, which needs INFO or DEBUG",
+    )
+    parser.add_argument("--work-dir", help="Where to write the tagger log")
+    parser.add_argument("tagger_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.tagger_args[:1] == ["--"]:
+        args.tagger_args = args.tagger_args[1:]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="s3_tagger_load_test_")
+    server_process, endpoint_url = start_fake_s3(args)
+    try:
+        return_code, elapsed, log_file_name = run_tagger(args, endpoint_url, work_dir)
+        stats = get_fake_s3_stats(endpoint_url)
+    finally:
+        server_process.terminate()
+
+    report(args, return_code, elapsed, log_file_name, stats)
+    sys.exit(return_code)
@@ -1,17 +1,56 @@
 import argparse
+import collections
+import cProfile
 import csv
+import functools
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
 import os
+import pstats
+import random
 import re
+import shutil
 import socket
+import sqlite3
+import statistics
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
 import boto3
 import botocore
 
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
 NAME_KEY = "Key"
 
+RESOLVE_FOUND = "found"
+RESOLVE_UNCLASSIFIED = "unclassified"
+RESOLVE_TABLE_MISSING = "table_missing"
+RESOLVE_NO_MATCH = "no_match"
+RESOLVE_SKIPPED = "skipped"
+
+PII_PRIORITIES = ["true", "false", "unclassified"]
+SQS_BATCH_SIZE = 10
+SQS_MAX_WAIT_SECONDS = 20
+DEFAULT_KEY_LAYOUT_RULES = [
+    "{db}/{table}",
+    "{db}/{table}/{partitions}",
+    "{db}/{table}/{any}",
+    "{db}/{table}/{partitions}/{any}",
+    "{db}/{table}/{any}/{any}",
+]
+
 boto_client_config = botocore.config.Config(
     max_pool_connections=100, retries={"max_attempts": 10, "mode": "standard"}
 )
@@ -45,10 +84,26 @@ def setup_logging(logger_level):
     return the_logger
 
 
-def read_csv(csv_location, s3_client):
+def split_s3_location(s3_location):
+    bucket = (re.search("s3://([a-zA-Z0-9-]*)", s3_location)).group(1)
+    key = ((re.search("s3://[a-zA-Z0-9-]*(.*)", s3_location)).group(1)).lstrip("/")
+    return bucket, key
+
+
+def parse_csv_file(file_name):
     csv_dict = {}
-    bucket = (re.search("s3://([a-zA-Z0-9-]*)", csv_location)).group(1)
-    key = ((re.search("s3://[a-zA-Z0-9-]*(.*)", csv_location)).group(1)).lstrip("/")
+    with open(file_name) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if row["db"] in csv_dict:
+                csv_dict[row["db"]].append({"table": row["table"], "pii": row["pii"]})
+            else:
+                csv_dict[row["db"]] = [{"table": row["table"], "pii": row["pii"]}]
+    return csv_dict
+
+
+def read_csv(csv_location, s3_client):
+    bucket, key = split_s3_location(csv_location)
     file_name = csv_location.split("/")[-1]
 
     logger.info(
@@ -62,15 +117,7 @@ def read_csv(csv_location, s3_client):
         logger.info(
             f'Attempting to read into dictionary", "csv_location": "{csv_location}", "csv_file_name": "{file_name}'
         )
-        with open(file_name) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["db"] in csv_dict:
-                    csv_dict[row["db"]].append(
-                        {"table": row["table"], "pii": row["pii"]}
-                    )
-                else:
-                    csv_dict[row["db"]] = [{"table": row["table"], "pii": row["pii"]}]
+        csv_dict = parse_csv_file(file_name)
         logger.info(
             f'Successfully read", "csv_location": "{csv_location}", "csv_file_name": "{file_name}'
         )
@@ -83,115 +130,582 @@ def read_csv(csv_location, s3_client):
         sys.exit(-1)
 
 
-def tag_object(key, s3_client, s3_bucket, csv_data):
-    split_string = key.split("/")
-    table_name = ""
-    db_name = ""
-    attempt_to_tag = False
+def read_csv_snapshot(snapshot_location, s3_client):
+    logger.info(
+        f'Reading previous CSV snapshot", "csv_snapshot_location": "{snapshot_location}'
+    )
 
-    if len(split_string) < 3:
-        logger.warning(
-            f'Skipping file as it doesn\'t appear to match output pattern", "key": "{key}'
+    try:
+        if snapshot_location.startswith("s3://"):
+            bucket, key = split_s3_location(snapshot_location)
+            try:
+                s3_client.head_object(Bucket=bucket, Key=key)
+            except botocore.exceptions.ClientError as err:
+                if err.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                    logger.warning(
+                        f'No previous CSV snapshot found, retagging everything", "csv_snapshot_location": "{snapshot_location}'
+                    )
+                    return None
+                raise
+            file_name = os.path.join(tempfile.mkdtemp(), "csv_snapshot.csv")
+            s3_client.download_file(bucket, key, file_name)
+        elif os.path.exists(snapshot_location):
+            file_name = snapshot_location
+        else:
+            logger.warning(
+                f'No previous CSV snapshot found, retagging everything", "csv_snapshot_location": "{snapshot_location}'
+            )
+            return None
+
+        return parse_csv_file(file_name)
+    except Exception as err:
+        logger.error(
+            f'Failed to read previous CSV snapshot", "csv_snapshot_location": "{snapshot_location}", "error_message": "{err}'
         )
-        return 0
+        sys.exit(-1)
 
-    if split_string[-1].endswith("_$folder$"):
-        split_string[-1] = split_string[-1][0:-9]
 
-    substring_in_list = any(".db" in item for item in split_string)
+def default_csv_snapshot_location(csv_location, data_bucket, data_s3_prefix):
+    # One snapshot per bucket and prefix, so runs that share a CSV but tag
+    # different prefixes each retag what changed since their own last run
+    prefix_hash = hashlib.sha1(data_s3_prefix.lstrip("/").encode("utf-8")).hexdigest()
+    return f"{csv_location}.{data_bucket}.{prefix_hash}.snapshot"
 
-    if substring_in_list:
-        for index, value in enumerate(split_string):
-            split_string[index] = (
-                value.replace(".db", "") if value.endswith(".db") else value
-            )
+
+def write_csv_snapshot(csv_location, snapshot_location, s3_client):
+    file_name = csv_location.split("/")[-1]
 
     try:
-        if split_string[-2] in csv_data:
-            db_name = split_string[-2]
-            table_name = split_string[-1]
-            attempt_to_tag = True
+        if snapshot_location.startswith("s3://"):
+            bucket, key = split_s3_location(snapshot_location)
+            s3_client.upload_file(file_name, bucket, key)
+        else:
+            shutil.copyfile(file_name, snapshot_location)
+        logger.info(
+            f'Saved CSV snapshot for the next delta run", "csv_snapshot_location": "{snapshot_location}'
+        )
+    except Exception as err:
+        logger.error(
+            f'Failed to save CSV snapshot", "csv_snapshot_location": "{snapshot_location}", "error_message": "{err}'
+        )
+
 
-        elif split_string[-3] in csv_data:
-            db_name = split_string[-3]
-            table_name = split_string[-2]
-            attempt_to_tag = True
+def table_pii_values(csv_data):
+    pii_values = {}
+    for db_name, tables in csv_data.items():
+        for table in tables:
+            pii_value = table["pii"] if type(table["pii"]) == str else ""
+            pii_values[(db_name, table["table"])] = pii_value
+    return pii_values
 
-        elif split_string[-4] in csv_data:
-            db_name = split_string[-4]
-            table_name = split_string[-3]
-            attempt_to_tag = True
 
+def diff_csv_data(previous_csv_data, csv_data):
+    previous_pii_values = table_pii_values(previous_csv_data)
+    pii_values = table_pii_values(csv_data)
+
+    added_tables = sorted(set(pii_values) - set(previous_pii_values))
+    removed_tables = sorted(set(previous_pii_values) - set(pii_values))
+    changed_tables = sorted(
+        table_key
+        for table_key, pii_value in pii_values.items()
+        if table_key in previous_pii_values
+        and previous_pii_values[table_key] != pii_value
+    )
+
+    logger.info(
+        f'CSV changes since previous snapshot", "added_tables_count": "{len(added_tables)}", '
+        f'"changed_tables_count": "{len(changed_tables)}", "removed_tables_count": "{len(removed_tables)}", '
+        f'"added_tables": "{[".".join(table_key) for table_key in added_tables]}", '
+        f'"changed_tables": "{[".".join(table_key) for table_key in changed_tables]}", '
+        f'"removed_tables": "{[".".join(table_key) for table_key in removed_tables]}'
+    )
+    for db_name, table_name in changed_tables:
+        logger.info(
+            f'Table classification changed", "db_name": "{db_name}", "table_name": "{table_name}", '
+            f'"previous_pii": "{previous_pii_values[(db_name, table_name)]}", "pii": "{pii_values[(db_name, table_name)]}'
+        )
+
+    return sorted(added_tables + changed_tables)
+
+
+def read_key_layout_rules(key_layout_location, s3_client):
+    logger.info(
+        f'Reading key layout rules", "key_layout_location": "{key_layout_location}'
+    )
+
+    try:
+        if key_layout_location.startswith("s3://"):
+            bucket, key = split_s3_location(key_layout_location)
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            key_layout_config = json.loads(response["Body"].read())
         else:
+            with open(key_layout_location) as f:
+                key_layout_config = json.load(f)
+
+        rules = key_layout_config["rules"]
+        logger.info(f'Read key layout rules", "rules": "{rules}')
+        return rules
+    except Exception as err:
+        logger.error(
+            f'Failed to read key layout rules", "key_layout_location": "{key_layout_location}", "error_message": "{err}'
+        )
+        sys.exit(-1)
+
+
+class KeyLayout:
+    def __init__(self, csv_data, rules=DEFAULT_KEY_LAYOUT_RULES):
+        db_names = sorted(csv_data, key=len, reverse=True)
+        db_pattern = (
+            "|".join(re.escape(db_name[::-1]) for db_name in db_names) or "(?!)"
+        )
+
+        rule_patterns = []
+        for index, rule in enumerate(rules):
+            rule_patterns.append(self._compile_rule(rule, index, db_pattern))
+
+        # Rules are matched against the reversed key so every rule is anchored
+        # at the end of the key and no backtracking through the prefix is needed
+        self.pattern = re.compile(
+            r"(?:\$redlof\$_)?(?:" + "|".join(rule_patterns) + ")"
+        )
+
+        # Each rule ends in an empty marker group, so the index of the last
+        # group matched identifies the rule without searching the groups
+        self.rule_groups = {}
+        for index, rule in enumerate(rules):
+            self.rule_groups[self.pattern.groupindex[f"rule{index}"]] = (
+                self.pattern.groupindex[f"db{index}"],
+                self.pattern.groupindex[f"table{index}"],
+                self.pattern.groupindex.get(f"partitions{index}"),
+            )
+
+        self.table_info = table_pii_values(csv_data)
+
+    @staticmethod
+    def _compile_rule(rule, index, db_pattern):
+        token_patterns = {
+            "db": f"(?:bd\\.)?(?P<db{index}>{db_pattern})",
+            "table": f"(?:bd\\.)?(?P<table{index}>[^/]*)",
+            "partitions": f"(?P<partitions{index}>[^/]*=[^/=]+(?:/[^/]*=[^/=]+)*?)",
+            "any": "[^/]*",
+        }
+        tokens = re.findall("{([^}]*)}", rule)
+        if tokens.count("db") != 1 or tokens.count("table") != 1:
+            raise ValueError(
+                f"Key layout rule '{rule}' must contain {{db}} and {{table}} exactly once"
+            )
+
+        rule_pattern = ""
+        for literal, token in reversed(re.findall("([^{]*)(?:{([^}]*)})?", rule)):
+            if token:
+                if token not in token_patterns:
+                    raise ValueError(
+                        f"Unknown token '{{{token}}}' in key layout rule '{rule}'"
+                    )
+                rule_pattern += token_patterns[token]
+            rule_pattern += re.escape(literal[::-1])
+
+        return rule_pattern + f"(?=/|$)(?P<rule{index}>)"
+
+    def match(self, key):
+        match = self.pattern.match(key[::-1])
+        if match is None:
+            return None
+
+        db_group, table_group, partitions_group = self.rule_groups[match.lastindex]
+        partitions = {}
+        if partitions_group is not None:
+            for partition in match.group(partitions_group)[::-1].split("/"):
+                name, _, value = partition.partition("=")
+                partitions[name] = value
+
+        return match.group(db_group)[::-1], match.group(table_group)[::-1], partitions
+
+
+def rules_have_table_directories(rules):
+    # Finding table directories by listing assumes the table directory sits
+    # directly below the database directory
+    return all(re.search(r"\{db\}/\{table\}(?:/|$)", rule) for rule in rules)
+
+
+def resolve_tags(key, csv_data, key_layout=None):
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
+
+    if key.count("/") < 2:
+        return RESOLVE_SKIPPED, "", "", "", {}
+
+    matched = key_layout.match(key)
+    if matched is None:
+        return RESOLVE_NO_MATCH, "", "", "", {}
+
+    db_name, table_name, partitions = matched
+    pii_value = key_layout.table_info.get((db_name, table_name))
+
+    if pii_value is None:
+        return RESOLVE_TABLE_MISSING, db_name, table_name, "", partitions
+    elif pii_value == "":
+        return RESOLVE_UNCLASSIFIED, db_name, table_name, pii_value, partitions
+
+    return RESOLVE_FOUND, db_name, table_name, pii_value, partitions
+
+
+def build_tag_set(db_name, table_name, pii_value):
+    return [
+        {"Key": "db", "Value": db_name},
+        {"Key": "table", "Value": table_name},
+        {"Key": "pii", "Value": pii_value},
+    ]
+
+
+def tag_set_hash(db_name, table_name, pii_value):
+    return hashlib.sha1(f"{db_name}\0{table_name}\0{pii_value}".encode()).hexdigest()
+
+
+class TaggingLedger:
+    def __init__(self, ledger_path, batch_size=1000):
+        self.ledger_path = ledger_path
+        self.batch_size = batch_size
+        self.pending = []
+        self.recorded_count = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(ledger_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tagged_objects ("
+            "key TEXT PRIMARY KEY, etag TEXT NOT NULL, "
+            "tag_set_hash TEXT NOT NULL, tagged_at INTEGER NOT NULL)"
+        )
+        self.connection.commit()
+
+    def unchanged_keys(self, candidates, chunk_size=500):
+        unchanged = set()
+        with self.lock:
+            for start in range(0, len(candidates), chunk_size):
+                chunk = {
+                    key: (etag, tag_hash)
+                    for key, etag, tag_hash in candidates[start : start + chunk_size]
+                }
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    "SELECT key, etag, tag_set_hash FROM tagged_objects "
+                    f"WHERE key IN ({placeholders})",
+                    list(chunk),
+                )
+                for key, etag, tag_hash in rows:
+                    if chunk[key] == (etag, tag_hash):
+                        unchanged.add(key)
+        return unchanged
+
+    def record(self, key, etag, tag_hash):
+        with self.lock:
+            self.pending.append((key, etag, tag_hash, int(time.time())))
+            if len(self.pending) >= self.batch_size:
+                self._flush_pending()
+
+    def _flush_pending(self):
+        if self.pending:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tagged_objects VALUES (?, ?, ?, ?)",
+                self.pending,
+            )
+            self.connection.commit()
+            self.recorded_count += len(self.pending)
+            self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush_pending()
+
+    def compact(self, max_age_days):
+        with self.lock:
+            self._flush_pending()
+            rows_before = self.connection.execute(
+                "SELECT COUNT(*) FROM tagged_objects"
+            ).fetchone()[0]
+            self.connection.execute(
+                "DELETE FROM tagged_objects WHERE tagged_at < ?",
+                (int(time.time()) - max_age_days * 86400,),
+            )
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            rows_after = self.connection.execute(
+                "SELECT COUNT(*) FROM tagged_objects"
+            ).fetchone()[0]
+        return rows_before, rows_after
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.connection.close()
+
+
+def open_ledger(ledger_path, ledger_s3_location, s3_client):
+    if ledger_s3_location:
+        bucket, key = split_s3_location(ledger_s3_location)
+        try:
+            s3_client.download_file(bucket, key, ledger_path)
+            logger.info(
+                f'Downloaded tagging ledger", "ledger_s3_location": "{ledger_s3_location}", "ledger_path": "{ledger_path}'
+            )
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                logger.error(
+                    f'Failed to download tagging ledger", "ledger_s3_location": "{ledger_s3_location}", "error_message": "{err}'
+                )
+                sys.exit(-1)
             logger.warning(
-                f'Couldn\'t establish a valid database and table name for key ", "table_name": "", "db_name": "", "key": "{key}'
+                f'No tagging ledger found, starting a new one", "ledger_s3_location": "{ledger_s3_location}'
             )
-            return 0
-    except Exception as e:
+
+    try:
+        return TaggingLedger(ledger_path)
+    except Exception as err:
         logger.error(
-            f'Caught exception when attempting to establish database name from key. Not tagging and continuing on", "key": "{key}", "exception": "{e}'
+            f'Failed to open tagging ledger", "ledger_path": "{ledger_path}", "error_message": "{err}'
         )
-        return 0
+        sys.exit(-1)
 
-    pii_value = ""
-    tag_info_found = False
 
-    if attempt_to_tag:
-        for table in csv_data[db_name]:
-            if table_name == table["table"]:
-                pii_value = table["pii"]
-                tag_info_found = True
+def close_ledger(ledger, ledger_s3_location, s3_client):
+    ledger.close()
+    logger.info(
+        f'Closed tagging ledger", "ledger_path": "{ledger.ledger_path}", "recorded_count": "{ledger.recorded_count}'
+    )
+
+    if ledger_s3_location:
+        bucket, key = split_s3_location(ledger_s3_location)
+        try:
+            s3_client.upload_file(ledger.ledger_path, bucket, key)
+            logger.info(
+                f'Uploaded tagging ledger", "ledger_s3_location": "{ledger_s3_location}'
+            )
+        except Exception as err:
+            logger.error(
+                f'Failed to upload tagging ledger", "ledger_s3_location": "{ledger_s3_location}", "error_message": "{err}'
+            )
 
-    if type(pii_value) != str:
-        pii_value = ""
 
-    if not tag_info_found:
+def filter_unchanged_objects(objects_to_tag, csv_data, key_layout, ledger, etags):
+    candidates = []
+    for key in objects_to_tag:
+        if key not in etags:
+            continue
+        status, db_name, table_name, pii_value, _ = resolve_tags(
+            key, csv_data, key_layout
+        )
+        if status not in (RESOLVE_SKIPPED, RESOLVE_NO_MATCH):
+            candidates.append(
+                (key, etags[key], tag_set_hash(db_name, table_name, pii_value))
+            )
+
+    unchanged = ledger.unchanged_keys(candidates)
+    logger.info(
+        f'Skipping objects already tagged with the same tags", "skipped_unchanged_count": "{len(unchanged)}'
+    )
+    return [key for key in objects_to_tag if key not in unchanged]
+
+
+def prioritise_objects(objects_to_tag, csv_data, key_layout):
+    prioritised_objects = {priority: [] for priority in PII_PRIORITIES}
+    for key in objects_to_tag:
+        _, _, _, pii_value, _ = resolve_tags(key, csv_data, key_layout)
+        if pii_value not in prioritised_objects:
+            pii_value = "unclassified"
+        prioritised_objects[pii_value].append(key)
+
+    return prioritised_objects
+
+
+# The size of the default ThreadPoolExecutor that tag_objects_threaded uses
+TAGGING_THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
+class RequestHedger:
+    # Each tagging thread has at most a primary and a hedge in flight, so the
+    # pool holds two per tagging thread and primaries do not queue. A losing
+    # call that is still running when its caller moves on keeps its thread
+    # until botocore times it out. If more losers than tagging threads hang
+    # at once, new primaries queue behind them, and the wait counts towards
+    # the hedge delay
+    def __init__(
+        self,
+        percentile,
+        budget,
+        max_workers=2 * TAGGING_THREADS,
+        window_size=1000,
+        min_samples=100,
+        recompute_every=100,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.recompute_every = recompute_every
+        self.latencies = collections.deque(maxlen=window_size)
+        self.latencies_since_recompute = 0
+        self.hedge_delay = None
+        self.requests = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _timed_call(self, function, kwargs):
+        start = time.monotonic()
+        result = function(**kwargs)
+        self._record_latency(time.monotonic() - start)
+        return result
+
+    def _record_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.latencies_since_recompute += 1
+            if (
+                len(self.latencies) >= self.min_samples
+                and self.latencies_since_recompute >= self.recompute_every
+            ):
+                ordered = sorted(self.latencies)
+                index = int(self.percentile / 100 * (len(ordered) - 1))
+                self.hedge_delay = ordered[index]
+                self.latencies_since_recompute = 0
+
+    def _take_hedge_budget(self):
+        with self.lock:
+            if self.hedges_sent >= self.budget * self.requests:
+                return False
+            self.hedges_sent += 1
+            return True
+
+    def call(self, function, **kwargs):
+        with self.lock:
+            self.requests += 1
+            hedge_delay = self.hedge_delay
+
+        primary = self.executor.submit(self._timed_call, function, kwargs)
+        if hedge_delay is None:
+            return primary.result()
+
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done or not self._take_hedge_budget():
+            return primary.result()
+
+        # Only safe because the hedged calls are idempotent
+        hedge = self.executor.submit(self._timed_call, function, kwargs)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    if future is hedge and future.exception() is None:
+                        with self.lock:
+                            self.hedges_won += 1
+                    return future.result()
+
+    def counts(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges_sent": self.hedges_sent,
+                "hedges_won": self.hedges_won,
+            }
+
+    def log_report(self):
+        with self.lock:
+            hedge_delay = (
+                f"{self.hedge_delay:.3f}" if self.hedge_delay is not None else ""
+            )
+            logger.info(
+                f'Hedged request report", "requests": "{self.requests}", '
+                f'"hedges_sent": "{self.hedges_sent}", "hedges_won": "{self.hedges_won}", '
+                f'"hedge_percentile": "{self.percentile}", "hedge_budget": "{self.budget}", '
+                f'"hedge_delay_seconds": "{hedge_delay}'
+            )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def tag_object(
+    key,
+    s3_client,
+    s3_bucket,
+    csv_data,
+    key_layout=None,
+    ledger=None,
+    etag=None,
+    hedger=None,
+    failed_keys=None,
+):
+    status, db_name, table_name, pii_value, _ = resolve_tags(key, csv_data, key_layout)
+
+    if status == RESOLVE_SKIPPED:
         logger.warning(
-            f'Table is missing from the CSV data ", "table_name": "{table_name}", "db_name": "{db_name}", "key": "{key}'
+            f'Skipping file as it doesn\'t appear to match output pattern", "key": "{key}'
         )
+        return 0
 
-    elif pii_value == "":
+    if status == RESOLVE_NO_MATCH:
         logger.warning(
-            f'No PII value as the table has yet to be classified ", "table_name": "{table_name}", "db_name": "{db_name}", "key": "{key}'
+            f'Couldn\'t establish a valid database and table name for key ", "table_name": "", "db_name": "", "key": "{key}'
         )
+        return 0
 
-    if attempt_to_tag:
-        try:
-            s3_client.put_object_tagging(
-                Bucket=s3_bucket,
-                Key=key,
-                Tagging={
-                    "TagSet": [
-                        {"Key": "db", "Value": db_name},
-                        {"Key": "table", "Value": table_name},
-                        {"Key": "pii", "Value": pii_value},
-                    ]
-                },
-            )
-            logger.info(f'Successfully tagged", "object": "{key}')
-        except Exception as err:
-            logger.error(f'Failed to tag", "object": "{key}", "error_message": "{err}')
-    else:
+    if status == RESOLVE_TABLE_MISSING:
+        logger.warning(
+            f'Table is missing from the CSV data ", "table_name": "{table_name}", "db_name": "{db_name}", "key": "{key}'
+        )
+
+    elif status == RESOLVE_UNCLASSIFIED:
         logger.warning(
-            f'Not attempting to tag due to invalid database or table name", "key": "{key}"'
+            f'No PII value as the table has yet to be classified ", "table_name": "{table_name}", "db_name": "{db_name}", "key": "{key}'
         )
 
-    if tag_info_found:
-        return 1
-    else:
+    try:
+        tagging_request = {
+            "Bucket": s3_bucket,
+            "Key": key,
+            "Tagging": {"TagSet": build_tag_set(db_name, table_name, pii_value)},
+        }
+        if hedger is not None:
+            hedger.call(s3_client.put_object_tagging, **tagging_request)
+        else:
+            s3_client.put_object_tagging(**tagging_request)
+        logger.info(f'Successfully tagged", "object": "{key}')
+        if ledger is not None and etag is not None:
+            ledger.record(key, etag, tag_set_hash(db_name, table_name, pii_value))
+    except Exception as err:
+        logger.error(f'Failed to tag", "object": "{key}", "error_message": "{err}')
+        if failed_keys is not None:
+            failed_keys.append(key)
+
+    if status == RESOLVE_TABLE_MISSING:
         return 0
+    else:
+        return 1
 
 
-def get_s3():
+def get_s3(endpoint_url=None):
     try:
-        s3_client = boto3.client("s3", config=boto_client_config)
+        if endpoint_url:
+            s3_client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                config=boto_client_config.merge(
+                    botocore.config.Config(s3={"addressing_style": "path"})
+                ),
+            )
+        else:
+            s3_client = boto3.client("s3", config=boto_client_config)
         return s3_client
     except Exception as err:
         logger.error(f'Failed to create an S3 client", "error_message": "{err}')
         sys.exit(-1)
 
 
-def get_objects_in_prefix(s3_bucket, s3_prefix, s3_client):
+def get_objects_in_prefix(s3_bucket, s3_prefix, s3_client, etags=None):
     # remove tailing or leading / from prefix
     if s3_prefix.startswith("/"):
         s3_prefix = s3_prefix.lstrip("/")
@@ -215,6 +729,10 @@ def get_objects_in_prefix(s3_bucket, s3_prefix, s3_client):
         else:
             logger.warning(f"No objects found to tag")
 
+        if etags is not None:
+            for object_ in objects_in_prefix:
+                etags[object_[NAME_KEY]] = object_["ETag"]
+
         return [object_[NAME_KEY] for object_ in objects_in_prefix]
 
     except Exception as err:
@@ -224,13 +742,405 @@ def get_objects_in_prefix(s3_bucket, s3_prefix, s3_client):
         raise err
 
 
-def tag_path(objects_to_tag, s3_client, s3_bucket, csv_data):
+def get_common_prefixes(s3_bucket, s3_prefix, s3_client):
+    common_prefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=s3_prefix, Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            common_prefixes.append(common_prefix["Prefix"])
+
+    return common_prefixes
+
+
+def find_table_directories(
+    s3_bucket,
+    s3_prefix,
+    s3_client,
+    table_keys,
+    max_depth=5,
+    db_names=None,
+    unexplored_directories=None,
+):
+    return [
+        table_directory
+        for _, table_directory in find_table_directories_by_table(
+            s3_bucket,
+            s3_prefix,
+            s3_client,
+            table_keys,
+            max_depth,
+            db_names,
+            unexplored_directories=unexplored_directories,
+        )
+    ]
+
+
+def find_table_directories_by_table(
+    s3_bucket,
+    s3_prefix,
+    s3_client,
+    table_keys,
+    max_depth=5,
+    db_names=None,
+    list_tables=False,
+    unexplored_directories=None,
+):
+    s3_prefix = s3_prefix.lstrip("/")
+    tables_by_db = {}
+    for db_name, table_name in table_keys:
+        tables_by_db.setdefault(db_name, []).append(table_name)
+
+    # Every database in the CSV, not just those with tables wanted, so the walk
+    # never descends into the table and partition directories of a database
+    db_names = set(db_names or ()) | set(tables_by_db)
+
+    def strip_db_suffix(name):
+        return name[:-3] if name.endswith(".db") else name
+
+    def tables_in_database(db_name, db_directory, table_prefix=""):
+        if not list_tables:
+            return [
+                ((db_name, table_name), db_directory + table_name)
+                for table_name in tables_by_db.get(db_name, [])
+                if table_name.startswith(table_prefix)
+            ]
+
+        # Listing finds the directories of tables missing from the CSV too
+        return [
+            (
+                (db_name, strip_db_suffix(common_prefix[len(db_directory) : -1])),
+                common_prefix[:-1],
+            )
+            for common_prefix in get_common_prefixes(
+                s3_bucket, db_directory + table_prefix, s3_client
+            )
+        ]
+
+    # The prefix may already be inside a database directory, e.g. data/db1/examp
+    segments = s3_prefix.split("/")[:-1]
+    for index in reversed(range(len(segments))):
+        db_name = strip_db_suffix(segments[index])
+        if db_name in db_names:
+            db_directory = "/".join(segments[: index + 1]) + "/"
+            table_prefix = s3_prefix[len(db_directory) :]
+            if list_tables and "/" in table_prefix:
+                table_name = strip_db_suffix(table_prefix.split("/")[0])
+                return [((db_name, table_name), s3_prefix)]
+            elif list_tables:
+                return tables_in_database(db_name, db_directory, table_prefix)
+
+            return [
+                (
+                    (db_name, table_name),
+                    max(db_directory + table_name, s3_prefix, key=len),
+                )
+                for table_name in tables_by_db.get(db_name, [])
+                if (db_directory + table_name).startswith(s3_prefix)
+                or s3_prefix.startswith(db_directory + table_name)
+            ]
+
+    table_directories = []
+    directories = [s3_prefix]
+    for _ in range(max_depth):
+        next_directories = []
+        for directory in directories:
+            for common_prefix in get_common_prefixes(s3_bucket, directory, s3_client):
+                db_name = strip_db_suffix(common_prefix.rstrip("/").split("/")[-1])
+                if db_name in db_names:
+                    table_directories.extend(tables_in_database(db_name, common_prefix))
+                else:
+                    next_directories.append(common_prefix)
+        directories = next_directories
+
+    if directories:
+        logger.error(
+            f'Stopped looking for table directories at the depth limit", "data_bucket": "{s3_bucket}", '
+            f'"data_s3_prefix": "{s3_prefix}", "max_depth": "{max_depth}", '
+            f'"unexplored_directories_count": "{len(directories)}", "unexplored_directories": "{directories}'
+        )
+        if unexplored_directories is not None:
+            unexplored_directories.extend(directories)
+
+    return table_directories
+
+
+def get_objects_in_tables(
+    s3_bucket, s3_prefix, s3_client, table_keys, csv_data, key_layout=None, etags=None
+):
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
+
+    unexplored_directories = []
+    table_directories = find_table_directories(
+        s3_bucket,
+        s3_prefix,
+        s3_client,
+        table_keys,
+        db_names=csv_data,
+        unexplored_directories=unexplored_directories,
+    )
+    logger.info(
+        f'Found table directories to retag", "number_of_tables": "{len(table_keys)}", '
+        f'"number_of_table_directories": "{len(table_directories)}'
+    )
+    if unexplored_directories:
+        # Database directories may sit below the depth limit, so whatever the
+        # walk did not reach is listed in full instead
+        logger.info(
+            f'Listing unexplored directories in full", '
+            f'"number_of_directories": "{len(unexplored_directories)}'
+        )
+        table_directories = table_directories + unexplored_directories
+
+    wanted_tables = set(table_keys)
+    objects_in_tables = []
+    for table_directory in table_directories:
+        # No trailing / so table_$folder$ markers are listed too, which means
+        # neighbours like tab10 for tab1 have to be filtered back out
+        for key in get_objects_in_prefix(s3_bucket, table_directory, s3_client, etags):
+            _, db_name, table_name, _, _ = resolve_tags(key, csv_data, key_layout)
+            if (db_name, table_name) in wanted_tables:
+                objects_in_tables.append(key)
+
+    return objects_in_tables
+
+
+def tag_path(
+    objects_to_tag,
+    s3_client,
+    s3_bucket,
+    csv_data,
+    key_layout=None,
+    ledger=None,
+    etags=None,
+    hedger=None,
+):
     logger.info(f'Found objects to tag", "number_of_objects": "{len(objects_to_tag)}')
     tagged_objects_count = 0
+    priority_completion = {}
+    failed_keys = []
+
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
 
-    for result in tag_objects_threaded(objects_to_tag, s3_client, s3_bucket, csv_data):
+    if ledger is not None:
+        objects_to_tag = filter_unchanged_objects(
+            objects_to_tag, csv_data, key_layout, ledger, etags or {}
+        )
+
+    for result in tag_objects_threaded(
+        objects_to_tag,
+        s3_client,
+        s3_bucket,
+        csv_data,
+        key_layout,
+        ledger,
+        etags,
+        hedger,
+        priority_completion,
+        failed_keys,
+    ):
         tagged_objects_count = tagged_objects_count + result
 
+    if ledger is not None:
+        ledger.flush()
+
+    log_tagged_count(tagged_objects_count)
+    log_failed_count(len(failed_keys))
+    log_priority_completion(priority_completion)
+
+    if hedger is not None:
+        hedger.log_report()
+
+    return len(failed_keys)
+
+
+class LedgerRecorder:
+    # Collects what a tagging process would write to the ledger so the parent,
+    # which owns the SQLite file, can record it
+    def __init__(self):
+        self.records = []
+
+    def record(self, key, etag, tag_hash):
+        self.records.append((key, etag, tag_hash))
+
+    def flush(self):
+        pass
+
+
+def partition_objects_by_table(
+    objects_to_tag, csv_data, key_layout, number_of_partitions
+):
+    objects_by_table = {}
+    for key in objects_to_tag:
+        _, db_name, table_name, _, _ = resolve_tags(key, csv_data, key_layout)
+        objects_by_table.setdefault((db_name, table_name), []).append(key)
+
+    # Tables bigger than an even share are split so one large table cannot
+    # leave the other processes idle
+    share = math.ceil(len(objects_to_tag) / number_of_partitions)
+    table_chunks = []
+    for table_objects in objects_by_table.values():
+        for index in range(0, len(table_objects), share):
+            table_chunks.append(table_objects[index : index + share])
+
+    partitions = [[] for _ in range(number_of_partitions)]
+    for table_chunk in sorted(table_chunks, key=len, reverse=True):
+        min(partitions, key=len).extend(table_chunk)
+
+    return [partition for partition in partitions if partition]
+
+
+def stop_inherited_profiling():
+    # Forked processes inherit the parent's profiling hooks, but only the
+    # parent's profiles are reported, so the overhead would be wasted
+    sys.setprofile(None)
+    threading.setprofile(None)
+    # From Python 3.12 cProfile hooks in through sys.monitoring instead
+    if hasattr(sys, "monitoring") and sys.monitoring.get_tool(
+        sys.monitoring.PROFILER_ID
+    ):
+        sys.monitoring.set_events(sys.monitoring.PROFILER_ID, 0)
+        sys.monitoring.free_tool_id(sys.monitoring.PROFILER_ID)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def tag_objects_in_process(
+    objects_to_tag,
+    s3_bucket,
+    csv_data,
+    key_layout,
+    s3_endpoint_url,
+    etags,
+    record_ledger,
+    hedge_percentile,
+    hedge_budget,
+):
+    s3_client = get_s3(s3_endpoint_url)
+    ledger = LedgerRecorder() if record_ledger else None
+    hedger = None
+    if hedge_percentile > 0:
+        hedger = RequestHedger(hedge_percentile, hedge_budget)
+
+    priority_completion = {}
+    failed_keys = []
+    tagged_objects_count = sum(
+        tag_objects_threaded(
+            objects_to_tag,
+            s3_client,
+            s3_bucket,
+            csv_data,
+            key_layout,
+            ledger,
+            etags,
+            hedger,
+            priority_completion,
+            failed_keys,
+        )
+    )
+
+    if hedger is not None:
+        hedger.log_report()
+        hedger.shutdown()
+
+    return (
+        tagged_objects_count,
+        len(failed_keys),
+        priority_completion,
+        ledger.records if ledger is not None else [],
+    )
+
+
+def tag_path_multiprocess(
+    objects_to_tag,
+    s3_bucket,
+    csv_data,
+    key_layout,
+    processes,
+    s3_endpoint_url=None,
+    ledger=None,
+    etags=None,
+    hedge_percentile=0,
+    hedge_budget=0.05,
+):
+    logger.info(f'Found objects to tag", "number_of_objects": "{len(objects_to_tag)}')
+
+    if etags is None:
+        etags = {}
+
+    if ledger is not None:
+        objects_to_tag = filter_unchanged_objects(
+            objects_to_tag, csv_data, key_layout, ledger, etags
+        )
+
+    partitions = partition_objects_by_table(
+        objects_to_tag, csv_data, key_layout, processes
+    )
+    logger.info(
+        f'Tagging in processes", "processes": "{len(partitions)}", '
+        f'"objects_per_process": "{[len(partition) for partition in partitions]}'
+    )
+
+    tagged_objects_count = 0
+    failed_objects_count = 0
+    priority_completion = {}
+    # Forked processes inherit the logging set up by the parent
+    with ProcessPoolExecutor(
+        max_workers=max(len(partitions), 1),
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=stop_inherited_profiling,
+    ) as executor:
+        futures = [
+            executor.submit(
+                tag_objects_in_process,
+                partition,
+                s3_bucket,
+                csv_data,
+                key_layout,
+                s3_endpoint_url,
+                {key: etags[key] for key in partition if key in etags},
+                ledger is not None,
+                hedge_percentile,
+                hedge_budget,
+            )
+            for partition in partitions
+        ]
+
+        for future in futures:
+            (
+                process_tagged_count,
+                process_failed_count,
+                process_priority_completion,
+                ledger_records,
+            ) = future.result()
+            tagged_objects_count += process_tagged_count
+            failed_objects_count += process_failed_count
+
+            for priority, completion in process_priority_completion.items():
+                merged = priority_completion.setdefault(
+                    priority, {"objects": 0, "completed_seconds": 0.0}
+                )
+                merged["objects"] += completion["objects"]
+                merged["completed_seconds"] = max(
+                    merged["completed_seconds"], completion["completed_seconds"]
+                )
+
+            for key, etag, tag_hash in ledger_records:
+                ledger.record(key, etag, tag_hash)
+
+    if ledger is not None:
+        ledger.flush()
+
+    log_tagged_count(tagged_objects_count)
+    log_failed_count(failed_objects_count)
+    log_priority_completion(priority_completion)
+
+    return failed_objects_count
+
+
+def log_tagged_count(tagged_objects_count):
     if tagged_objects_count == 0:
         logger.info(
             f'Did not tag any objects", "number_of_objects": "{tagged_objects_count}'
@@ -239,14 +1149,82 @@ def tag_path(objects_to_tag, s3_client, s3_bucket, csv_data):
         logger.info(f'Tagged", "objects_tagged_count": "{tagged_objects_count}')
 
 
-def tag_objects_threaded(objects_to_tag, s3_client, s3_bucket, csv_data):
+def log_failed_count(failed_objects_count):
+    if failed_objects_count > 0:
+        logger.error(
+            f'Failed to tag objects", "failed_objects_count": "{failed_objects_count}'
+        )
+
+
+def log_priority_completion(priority_completion):
+    for priority in PII_PRIORITIES:
+        if priority in priority_completion:
+            logger.info(
+                f'Finished tagging priority", "pii_priority": "{priority}", '
+                f'"number_of_objects": "{priority_completion[priority]["objects"]}", '
+                f'"completed_seconds": "{priority_completion[priority]["completed_seconds"]:.3f}'
+            )
+
+
+def tag_objects_threaded(
+    objects_to_tag,
+    s3_client,
+    s3_bucket,
+    csv_data,
+    key_layout=None,
+    ledger=None,
+    etags=None,
+    hedger=None,
+    priority_completion=None,
+    failed_keys=None,
+):
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
+
+    if etags is None:
+        etags = {}
+
+    if priority_completion is None:
+        priority_completion = {}
+
+    # The executor runs work in the order it is submitted, so submitting
+    # pii=true objects first gets them tagged first
+    prioritised_objects = prioritise_objects(objects_to_tag, csv_data, key_layout)
+    start = time.monotonic()
+    completion_lock = threading.Lock()
+
+    def record_completion(priority, future):
+        with completion_lock:
+            priority_completion[priority]["completed_seconds"] = (
+                time.monotonic() - start
+            )
+
     with ThreadPoolExecutor() as executor:
         future_results = []
 
-        for row in objects_to_tag:
-            future_results.append(
-                executor.submit(tag_object, row, s3_client, s3_bucket, csv_data)
-            )
+        for priority in PII_PRIORITIES:
+            if not prioritised_objects[priority]:
+                continue
+
+            priority_completion[priority] = {
+                "objects": len(prioritised_objects[priority]),
+                "completed_seconds": 0.0,
+            }
+            for row in prioritised_objects[priority]:
+                future = executor.submit(
+                    tag_object,
+                    row,
+                    s3_client,
+                    s3_bucket,
+                    csv_data,
+                    key_layout,
+                    ledger,
+                    etags.get(row),
+                    hedger,
+                    failed_keys,
+                )
+                future.add_done_callback(functools.partial(record_completion, priority))
+                future_results.append(future)
 
         wait(future_results)
         for future in future_results:
@@ -256,6 +1234,753 @@ def tag_objects_threaded(objects_to_tag, s3_client, s3_bucket, csv_data):
                 raise AssertionError(ex)
 
 
+def get_sqs(endpoint_url=None):
+    try:
+        return boto3.client(
+            "sqs", endpoint_url=endpoint_url or None, config=boto_client_config
+        )
+    except Exception as err:
+        logger.error(f'Failed to create an SQS client", "error_message": "{err}')
+        sys.exit(-1)
+
+
+def build_work_units(s3_bucket, s3_prefix, s3_client, key_layout, run_id):
+    # Table directories are listed rather than taken from the CSV so objects
+    # of tables missing from the CSV are tagged, as they are in tag mode
+    unexplored_directories = []
+    table_directories = find_table_directories_by_table(
+        s3_bucket,
+        s3_prefix,
+        s3_client,
+        sorted(key_layout.table_info),
+        list_tables=True,
+        unexplored_directories=unexplored_directories,
+    )
+    if unexplored_directories:
+        raise RuntimeError(
+            f"Found no database directories in {len(unexplored_directories)} "
+            f"directories at the depth limit, so their objects cannot be queued"
+        )
+    missing_tables = sorted(
+        {
+            table_key
+            for table_key, _ in table_directories
+            if table_key not in key_layout.table_info
+        }
+    )
+    if missing_tables:
+        logger.warning(
+            f'Found table directories for tables missing from the CSV", '
+            f'"number_of_tables": "{len(missing_tables)}", "tables": "{missing_tables}'
+        )
+
+    def pii_priority(table_directory):
+        pii_value = key_layout.table_info.get(table_directory[0], "")
+        if pii_value not in PII_PRIORITIES:
+            pii_value = "unclassified"
+        return PII_PRIORITIES.index(pii_value)
+
+    # Queue pii=true tables first, workers pick units up roughly in send order
+    return [
+        {
+            "run_id": run_id,
+            "unit_id": str(index),
+            "db": db_name,
+            "table": table_name,
+            "table_directory": table_directory,
+        }
+        for index, ((db_name, table_name), table_directory) in enumerate(
+            sorted(table_directories, key=pii_priority)
+        )
+    ]
+
+
+def send_work_units(work_units, sqs_client, queue_url):
+    for index in range(0, len(work_units), SQS_BATCH_SIZE):
+        batch = work_units[index : index + SQS_BATCH_SIZE]
+        response = sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": work_unit["unit_id"], "MessageBody": json.dumps(work_unit)}
+                for work_unit in batch
+            ],
+        )
+        if response.get("Failed"):
+            logger.error(
+                f'Failed to send work units", "queue_url": "{queue_url}", '
+                f'"failed": "{response["Failed"]}'
+            )
+            raise RuntimeError(f"Failed to send {len(response['Failed'])} work units")
+
+
+def collect_work_results(sqs_client, queue_url, run_id, unit_ids, timeout_seconds):
+    results = {}
+    deadline = time.monotonic() + timeout_seconds
+    while len(results) < len(unit_ids):
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            logger.error(
+                f'Timed out waiting for work results", "queue_url": "{queue_url}", '
+                f'"work_units": "{len(unit_ids)}", "work_results": "{len(results)}'
+            )
+            raise RuntimeError(
+                f"Received results for {len(results)} of {len(unit_ids)} work units"
+            )
+
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=SQS_BATCH_SIZE,
+            WaitTimeSeconds=int(min(SQS_MAX_WAIT_SECONDS, remaining_seconds)),
+        )
+        run_messages = []
+        other_run_messages = []
+        for message in response.get("Messages", []):
+            result = json.loads(message["Body"])
+            if result["run_id"] != run_id:
+                other_run_messages.append(message)
+                continue
+
+            run_messages.append(message)
+            if result["unit_id"] in unit_ids:
+                # Redelivered work units can be reported twice, the first result is kept
+                results.setdefault(result["unit_id"], result)
+
+        if run_messages:
+            sqs_client.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": str(index), "ReceiptHandle": message["ReceiptHandle"]}
+                    for index, message in enumerate(run_messages)
+                ],
+            )
+
+        if other_run_messages:
+            # Another coordinator sharing the queue may be waiting for these,
+            # so they are made visible again rather than deleted
+            logger.debug(
+                f'Returning work results from other runs to the queue", '
+                f'"number_of_results": "{len(other_run_messages)}'
+            )
+            sqs_client.change_message_visibility_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {
+                        "Id": str(index),
+                        "ReceiptHandle": message["ReceiptHandle"],
+                        "VisibilityTimeout": 0,
+                    }
+                    for index, message in enumerate(other_run_messages)
+                ],
+            )
+
+    return list(results.values())
+
+
+def coordinate_tagging(
+    s3_bucket,
+    s3_prefix,
+    s3_client,
+    sqs_client,
+    work_queue_url,
+    results_queue_url,
+    key_layout,
+    timeout_seconds,
+):
+    run_id = uuid.uuid4().hex
+    work_units = build_work_units(s3_bucket, s3_prefix, s3_client, key_layout, run_id)
+    logger.info(
+        f'Sending work units", "run_id": "{run_id}", "work_queue_url": "{work_queue_url}", '
+        f'"number_of_work_units": "{len(work_units)}'
+    )
+    send_work_units(work_units, sqs_client, work_queue_url)
+
+    results = collect_work_results(
+        sqs_client,
+        results_queue_url,
+        run_id,
+        {work_unit["unit_id"] for work_unit in work_units},
+        timeout_seconds,
+    )
+
+    table_directories = {
+        work_unit["unit_id"]: work_unit["table_directory"] for work_unit in work_units
+    }
+    worker_results = {}
+    for result in results:
+        worker_result = worker_results.setdefault(
+            result["worker_id"],
+            {
+                "work_units": 0,
+                "failed_work_units": 0,
+                "number_of_objects": 0,
+                "objects_tagged_count": 0,
+            },
+        )
+        worker_result["work_units"] += 1
+        worker_result["number_of_objects"] += result["number_of_objects"]
+        worker_result["objects_tagged_count"] += result["objects_tagged_count"]
+        if result.get("error"):
+            worker_result["failed_work_units"] += 1
+            logger.error(
+                f'Work unit failed", "worker_id": "{result["worker_id"]}", "unit_id": "{result["unit_id"]}", '
+                f'"table_directory": "{table_directories[result["unit_id"]]}", "error_message": "{result["error"]}'
+            )
+
+    for worker_id, worker_result in sorted(worker_results.items()):
+        logger.info(
+            f'Worker results", "worker_id": "{worker_id}", '
+            f'"work_units": "{worker_result["work_units"]}", '
+            f'"failed_work_units": "{worker_result["failed_work_units"]}", '
+            f'"number_of_objects": "{worker_result["number_of_objects"]}", '
+            f'"objects_tagged_count": "{worker_result["objects_tagged_count"]}'
+        )
+
+    logger.info(
+        f'Found objects to tag", "number_of_objects": '
+        f'"{sum(result["number_of_objects"] for result in results)}'
+    )
+    tagged_objects_count = sum(result["objects_tagged_count"] for result in results)
+    log_tagged_count(tagged_objects_count)
+    log_failed_count(sum(result.get("failed_objects_count", 0) for result in results))
+
+    hedge_counts = collections.Counter()
+    for result in results:
+        hedge_counts.update(result.get("hedge_counts", {}))
+    if hedge_counts:
+        logger.info(
+            f'Hedged request report", "requests": "{hedge_counts["requests"]}", '
+            f'"hedges_sent": "{hedge_counts["hedges_sent"]}", "hedges_won": "{hedge_counts["hedges_won"]}'
+        )
+
+    failed_work_units_count = sum(1 for result in results if result.get("error"))
+    if failed_work_units_count > 0:
+        logger.error(
+            f'Work units failed to tag", "failed_work_units_count": "{failed_work_units_count}", '
+            f'"number_of_work_units": "{len(work_units)}'
+        )
+    return tagged_objects_count
+
+
+def tag_work_unit(work_unit, s3_bucket, s3_client, csv_data, key_layout, hedger=None):
+    objects_to_tag = get_objects_in_tables(
+        s3_bucket,
+        work_unit["table_directory"],
+        s3_client,
+        [(work_unit["db"], work_unit["table"])],
+        csv_data,
+        key_layout,
+    )
+    failed_keys = []
+    tagged_objects_count = sum(
+        tag_objects_threaded(
+            objects_to_tag,
+            s3_client,
+            s3_bucket,
+            csv_data,
+            key_layout,
+            hedger=hedger,
+            failed_keys=failed_keys,
+        )
+    )
+    return len(objects_to_tag), tagged_objects_count, len(failed_keys)
+
+
+def extend_visibility_until_done(
+    sqs_client, queue_url, receipt_handle, visibility_timeout, done
+):
+    # Extending well before the timeout runs out leaves time for retries
+    while not done.wait(visibility_timeout / 3):
+        try:
+            sqs_client.change_message_visibility(
+                QueueUrl=queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=visibility_timeout,
+            )
+        except Exception as err:
+            logger.warning(
+                f'Failed to extend work unit visibility", "queue_url": "{queue_url}", "error_message": "{err}'
+            )
+
+
+def process_work_units(
+    s3_bucket,
+    s3_client,
+    sqs_client,
+    work_queue_url,
+    results_queue_url,
+    csv_data,
+    key_layout,
+    idle_seconds,
+    hedger=None,
+    visibility_timeout=60,
+):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    work_units_processed = 0
+    idle_since = time.monotonic()
+    while True:
+        remaining_seconds = idle_seconds - (time.monotonic() - idle_since)
+        response = sqs_client.receive_message(
+            QueueUrl=work_queue_url,
+            MaxNumberOfMessages=1,
+            VisibilityTimeout=visibility_timeout,
+            WaitTimeSeconds=int(min(SQS_MAX_WAIT_SECONDS, max(remaining_seconds, 0))),
+        )
+        messages = response.get("Messages", [])
+        if not messages and remaining_seconds <= 0:
+            break
+
+        for message in messages:
+            work_unit = json.loads(message["Body"])
+            logger.info(
+                f'Tagging work unit", "worker_id": "{worker_id}", "unit_id": "{work_unit["unit_id"]}", '
+                f'"table_directory": "{work_unit["table_directory"]}'
+            )
+            # Keep the unit hidden from other workers for as long as it takes
+            # to tag, however large the table is
+            done = threading.Event()
+            heartbeat = threading.Thread(
+                target=extend_visibility_until_done,
+                args=(
+                    sqs_client,
+                    work_queue_url,
+                    message["ReceiptHandle"],
+                    visibility_timeout,
+                    done,
+                ),
+                daemon=True,
+            )
+            heartbeat.start()
+            error_message = None
+            hedge_counts_before = hedger.counts() if hedger is not None else {}
+            try:
+                (
+                    number_of_objects,
+                    tagged_objects_count,
+                    failed_objects_count,
+                ) = tag_work_unit(
+                    work_unit, s3_bucket, s3_client, csv_data, key_layout, hedger
+                )
+            except Exception as err:
+                # Reported rather than raised, as a redelivered unit that fails
+                # every time would otherwise stop every worker in turn
+                logger.error(
+                    f'Failed to tag work unit", "worker_id": "{worker_id}", "unit_id": "{work_unit["unit_id"]}", '
+                    f'"table_directory": "{work_unit["table_directory"]}", "error_message": "{err}'
+                )
+                number_of_objects, tagged_objects_count, failed_objects_count = 0, 0, 0
+                error_message = str(err)
+            finally:
+                done.set()
+                heartbeat.join()
+
+            hedge_counts = {
+                name: count - hedge_counts_before[name]
+                for name, count in (
+                    hedger.counts() if hedger is not None else {}
+                ).items()
+            }
+
+            # The unit is only acknowledged once its result is sent, so a worker
+            # that dies part way through leaves the unit to be redelivered
+            sqs_client.send_message(
+                QueueUrl=results_queue_url,
+                MessageBody=json.dumps(
+                    {
+                        "run_id": work_unit["run_id"],
+                        "unit_id": work_unit["unit_id"],
+                        "worker_id": worker_id,
+                        "number_of_objects": number_of_objects,
+                        "objects_tagged_count": tagged_objects_count,
+                        "failed_objects_count": failed_objects_count,
+                        "error": error_message,
+                        "hedge_counts": hedge_counts,
+                    }
+                ),
+            )
+            sqs_client.delete_message(
+                QueueUrl=work_queue_url, ReceiptHandle=message["ReceiptHandle"]
+            )
+            work_units_processed += 1
+            idle_since = time.monotonic()
+
+    if hedger is not None:
+        hedger.log_report()
+
+    logger.info(
+        f'Work queue idle, stopping worker", "worker_id": "{worker_id}", '
+        f'"work_units_processed": "{work_units_processed}'
+    )
+    return work_units_processed
+
+
+def audit_object(key, expected_tag_set, s3_client, s3_bucket):
+    try:
+        response = s3_client.get_object_tagging(Bucket=s3_bucket, Key=key)
+    except Exception as err:
+        logger.error(
+            f'Failed to get tags for audit", "object": "{key}", "error_message": "{err}'
+        )
+        return None
+
+    actual_tags = {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+    for expected_tag in expected_tag_set:
+        if actual_tags.get(expected_tag["Key"]) != expected_tag["Value"]:
+            return True
+
+    return False
+
+
+def group_objects_by_table(objects_to_group, csv_data, key_layout=None):
+    objects_by_table = {}
+
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
+
+    for key in objects_to_group:
+        status, db_name, table_name, pii_value, _ = resolve_tags(
+            key, csv_data, key_layout
+        )
+        if status in (RESOLVE_SKIPPED, RESOLVE_NO_MATCH):
+            continue
+
+        table_key = (db_name, table_name)
+        if table_key in objects_by_table:
+            objects_by_table[table_key]["keys"].append(key)
+        else:
+            objects_by_table[table_key] = {
+                "keys": [key],
+                "tag_set": build_tag_set(db_name, table_name, pii_value),
+            }
+
+    return objects_by_table
+
+
+def drift_confidence_bounds(drifted, sample_size, population, confidence):
+    if sample_size == 0:
+        return 0.0, 1.0
+
+    drift_rate = drifted / sample_size
+    if sample_size >= population:
+        return drift_rate, drift_rate
+
+    # Wilson score interval, which stays sensible for the small samples and
+    # zero-drift results that a healthy prefix produces
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    denominator = 1 + z**2 / sample_size
+    centre = drift_rate + z**2 / (2 * sample_size)
+    margin = z * math.sqrt(
+        drift_rate * (1 - drift_rate) / sample_size + z**2 / (4 * sample_size**2)
+    )
+    lower = max(0.0, (centre - margin) / denominator)
+    upper = min(1.0, (centre + margin) / denominator)
+    return lower, upper
+
+
+def stratified_drift_bounds(strata, confidence):
+    # Each table is a stratum of (drifted, sampled, population). The drifted
+    # total is estimated as the sum of each table's drift rate times its
+    # population, with a normal interval from the summed stratum variances
+    estimate = 0.0
+    variance = 0.0
+    known_drifted = 0
+    known_clean = 0
+    unsampled = 0
+    for drifted, sampled, population in strata:
+        if sampled == 0:
+            unsampled += population
+            continue
+
+        drift_rate = drifted / sampled
+        estimate += drift_rate * population
+        known_drifted += drifted
+        known_clean += sampled - drifted
+        if sampled < population:
+            finite_population_correction = 1 - sampled / population
+            variance += (
+                population**2
+                * finite_population_correction
+                * drift_rate
+                * (1 - drift_rate)
+                / sampled
+            )
+
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    margin = z * math.sqrt(variance)
+    sampled_population = sum(population for _, _, population in strata) - unsampled
+    lower = max(known_drifted, estimate - margin)
+    # Tables whose sample could not be checked may be entirely drifted
+    upper = min(sampled_population - known_clean, estimate + margin) + unsampled
+    return estimate, lower, upper
+
+
+def audit_path(
+    objects_to_audit,
+    s3_client,
+    s3_bucket,
+    csv_data,
+    sample_size,
+    confidence,
+    retag=False,
+    key_layout=None,
+):
+    if key_layout is None:
+        key_layout = KeyLayout(csv_data)
+
+    objects_by_table = group_objects_by_table(objects_to_audit, csv_data, key_layout)
+    logger.info(
+        f'Auditing sample of objects", "number_of_objects": "{len(objects_to_audit)}", '
+        f'"number_of_tables": "{len(objects_by_table)}", "sample_size_per_table": "{sample_size}'
+    )
+
+    samples = {}
+    for table_key, table_objects in objects_by_table.items():
+        keys = table_objects["keys"]
+        samples[table_key] = random.sample(keys, min(sample_size, len(keys)))
+
+    with ThreadPoolExecutor() as executor:
+        future_results = {
+            table_key: [
+                executor.submit(
+                    audit_object,
+                    key,
+                    objects_by_table[table_key]["tag_set"],
+                    s3_client,
+                    s3_bucket,
+                )
+                for key in sample
+            ]
+            for table_key, sample in samples.items()
+        }
+
+    audit_results = {}
+
+    for (db_name, table_name), futures in future_results.items():
+        results = [future.result() for future in futures]
+        checked = [result for result in results if result is not None]
+        drifted = sum(1 for result in checked if result)
+        population = len(objects_by_table[(db_name, table_name)]["keys"])
+        lower, upper = drift_confidence_bounds(
+            drifted, len(checked), population, confidence
+        )
+        drift_rate = drifted / len(checked) if checked else 0.0
+
+        audit_results[(db_name, table_name)] = {
+            "population": population,
+            "sampled": len(checked),
+            "drifted": drifted,
+            "errors": len(results) - len(checked),
+            "drift_rate": drift_rate,
+            "drift_lower_bound": lower,
+            "drift_upper_bound": upper,
+        }
+
+        log_message = (
+            f'Audited table", "db_name": "{db_name}", "table_name": "{table_name}", '
+            f'"population": "{population}", "sampled": "{len(checked)}", "drifted": "{drifted}", '
+            f'"drift_rate": "{drift_rate:.4f}", "drift_lower_bound": "{lower:.4f}", '
+            f'"drift_upper_bound": "{upper:.4f}", "confidence": "{confidence}'
+        )
+        if drifted > 0:
+            logger.warning(log_message)
+        else:
+            logger.info(log_message)
+
+    estimated_drift, estimated_drift_lower, estimated_drift_upper = (
+        stratified_drift_bounds(
+            [
+                (result["drifted"], result["sampled"], result["population"])
+                for result in audit_results.values()
+            ],
+            confidence,
+        )
+    )
+    logger.info(
+        f'Audit complete", "number_of_tables": "{len(audit_results)}", '
+        f'"estimated_drifted_objects": "{round(estimated_drift)}", '
+        f'"estimated_drifted_objects_lower_bound": "{round(estimated_drift_lower)}", '
+        f'"estimated_drifted_objects_upper_bound": "{round(estimated_drift_upper)}", '
+        f'"confidence": "{confidence}'
+    )
+
+    if retag:
+        objects_to_retag = []
+        for table_key, result in audit_results.items():
+            if result["drifted"] > 0:
+                objects_to_retag.extend(objects_by_table[table_key]["keys"])
+
+        if objects_to_retag:
+            logger.info(
+                f'Retagging tables with drift", "number_of_objects": "{len(objects_to_retag)}'
+            )
+            tag_path(objects_to_retag, s3_client, s3_bucket, csv_data, key_layout)
+        else:
+            logger.info("No drift found in sample, not retagging")
+
+    return audit_results
+
+
+class RunProfiler:
+    def __init__(self, profile_mode, output_location, s3_client, top_count=50):
+        self.profile_cpu = profile_mode in ("cpu", "both")
+        self.profile_memory = profile_mode in ("memory", "both")
+        self.output_location = output_location
+        self.s3_client = s3_client
+        self.top_count = top_count
+        self.cpu_profiles = []
+        self.cpu_profiles_lock = threading.Lock()
+        self.cpu_profiles_stopped = False
+        self.final_cpu_stats = None
+        self.snapshot_count = 0
+        self.snapshot_stop = threading.Event()
+        self.snapshot_thread = None
+
+    def _profile_new_thread(self, frame, event, arg):
+        # Runs as the first profile event of each new thread and swaps itself
+        # out for a cProfile profiler owned by that thread
+        thread_profile = cProfile.Profile()
+        with self.cpu_profiles_lock:
+            if self.cpu_profiles_stopped:
+                sys.setprofile(None)
+                return
+            self.cpu_profiles.append(thread_profile)
+        try:
+            thread_profile.enable()
+        except ValueError as err:
+            # Another profiler is already active, so this thread goes unprofiled
+            # rather than failing the work it was started for
+            sys.setprofile(None)
+            with self.cpu_profiles_lock:
+                self.cpu_profiles.remove(thread_profile)
+            logger.warning(
+                f'Failed to profile new thread", "thread_name": "{threading.current_thread().name}", '
+                f'"error_message": "{err}'
+            )
+
+    def start(self, snapshot_interval=0):
+        if self.profile_memory:
+            tracemalloc.start()
+
+        if self.profile_cpu:
+            # From Python 3.12 cProfile uses sys.monitoring, so one profiler
+            # sees every thread and a second one cannot be enabled
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._profile_new_thread)
+            main_profile = cProfile.Profile()
+            with self.cpu_profiles_lock:
+                self.cpu_profiles.append(main_profile)
+            main_profile.enable()
+
+        if snapshot_interval > 0:
+            self.snapshot_thread = threading.Thread(
+                target=self._write_snapshots, args=(snapshot_interval,), daemon=True
+            )
+            self.snapshot_thread.start()
+
+        logger.info(
+            f'Profiling started", "profile_cpu": "{self.profile_cpu}", '
+            f'"profile_memory": "{self.profile_memory}", "snapshot_interval": "{snapshot_interval}'
+        )
+
+    def stop(self):
+        self.snapshot_stop.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+
+        if self.profile_cpu:
+            self._disable_cpu_profiles()
+
+        self.write_reports()
+
+        if self.profile_memory:
+            tracemalloc.stop()
+
+    def _disable_cpu_profiles(self):
+        threading.setprofile(None)
+        with self.cpu_profiles_lock:
+            self.cpu_profiles_stopped = True
+            profiles = list(self.cpu_profiles)
+
+        for profile in profiles:
+            profile.disable()
+
+        # Before Python 3.12 disable() only unhooks the calling thread, so
+        # threads that outlive stop() keep profiling until they exit. Freezing
+        # the stats keeps them out of the final report
+        self.final_cpu_stats = self._cpu_stats()
+
+    def _write_snapshots(self, snapshot_interval):
+        while not self.snapshot_stop.wait(snapshot_interval):
+            self.snapshot_count += 1
+            self.write_reports(f"-snapshot-{self.snapshot_count}")
+
+    def _cpu_stats(self):
+        if self.final_cpu_stats is not None:
+            return self.final_cpu_stats
+
+        stats = pstats.Stats()
+        with self.cpu_profiles_lock:
+            profiles = list(self.cpu_profiles)
+
+        for profile in profiles:
+            profile.snapshot_stats()
+            if profile.stats:
+                stats.add(_ProfileStats(profile.stats))
+
+        return stats
+
+    def write_reports(self, suffix=""):
+        file_names = []
+        base_name = self.output_location
+        if base_name.startswith("s3://"):
+            base_name = tempfile.mkdtemp() + "/" + base_name.split("/")[-1]
+
+        try:
+            if self.profile_cpu:
+                stats = self._cpu_stats()
+                stats.dump_stats(f"{base_name}{suffix}.cpu.prof")
+                with open(f"{base_name}{suffix}.cpu.txt", "w") as f:
+                    stats.stream = f
+                    stats.sort_stats("cumulative").print_stats(self.top_count)
+                file_names.extend(
+                    [f"{base_name}{suffix}.cpu.prof", f"{base_name}{suffix}.cpu.txt"]
+                )
+
+            if self.profile_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                with open(f"{base_name}{suffix}.memory.txt", "w") as f:
+                    f.write(f"Current traced memory: {current} bytes\n")
+                    f.write(f"Peak traced memory: {peak} bytes\n")
+                    f.write(f"Top {self.top_count} allocations by line:\n")
+                    for stat in snapshot.statistics("lineno")[: self.top_count]:
+                        f.write(f"{stat}\n")
+                file_names.append(f"{base_name}{suffix}.memory.txt")
+
+            if self.output_location.startswith("s3://"):
+                bucket, key_prefix = split_s3_location(self.output_location)
+                for file_name in file_names:
+                    key = key_prefix + file_name[len(base_name) :]
+                    self.s3_client.upload_file(file_name, bucket, key)
+
+            logger.info(
+                f'Wrote profiling reports", "profile_output": "{self.output_location}", '
+                f'"suffix": "{suffix}", "number_of_files": "{len(file_names)}'
+            )
+        except Exception as err:
+            logger.error(
+                f'Failed to write profiling reports", "profile_output": "{self.output_location}", '
+                f'"error_message": "{err}'
+            )
+
+
+class _ProfileStats:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
 def get_parameters():
     parser = argparse.ArgumentParser(
         description="A Python script which receives six args:"
@@ -278,6 +2003,131 @@ def get_parameters():
     parser.add_argument("--log-level", default="INFO")
     parser.add_argument("--environment", default="NOT_SET")
     parser.add_argument("--application", default="NOT_SET")
+    parser.add_argument(
+        "--mode",
+        default="tag",
+        choices=["tag", "audit", "compact-ledger", "coordinate", "work"],
+        help="Tag every object, audit a sample of objects per table for tag drift, "
+        "compact the tagging ledger, queue table directories for workers to tag, "
+        "or tag table directories taken from the work queue",
+    )
+    parser.add_argument(
+        "--audit-sample-size",
+        type=int,
+        default=20,
+        help="The number of objects to check per table in audit mode",
+    )
+    parser.add_argument(
+        "--audit-confidence",
+        type=float,
+        default=0.95,
+        help="The confidence level for the drift bounds reported in audit mode",
+    )
+    parser.add_argument(
+        "--audit-retag",
+        action="store_true",
+        help="Retag every object in tables whose audit sample shows drift",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only retag tables added or changed since the previous CSV snapshot",
+    )
+    parser.add_argument(
+        "--csv-snapshot-location",
+        help="Where the CSV is saved after each delta run, defaults to the CSV location "
+        "suffixed with the data bucket and a hash of the data prefix",
+    )
+    parser.add_argument(
+        "--ledger-path",
+        help="A local SQLite file recording tagged objects, so unchanged objects are skipped",
+    )
+    parser.add_argument(
+        "--ledger-s3-location",
+        help="An S3 location the ledger is downloaded from before the run and uploaded to after it",
+    )
+    parser.add_argument(
+        "--ledger-max-age-days",
+        type=int,
+        default=90,
+        help="Ledger entries older than this are removed by compact-ledger mode",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=0,
+        help="Send a duplicate tagging request when one takes longer than this "
+        "percentile of recent tagging latencies, 0 to disable",
+    )
+    parser.add_argument(
+        "--hedge-budget",
+        type=float,
+        default=0.05,
+        help="The most duplicate tagging requests to send, as a fraction of all tagging requests",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Split the objects to tag by table across this many processes, "
+        "each with its own S3 client and thread pool",
+    )
+    parser.add_argument(
+        "--work-queue-url",
+        help="The SQS queue table directories are sent to in coordinate mode and taken from in work mode",
+    )
+    parser.add_argument(
+        "--results-queue-url",
+        help="The SQS queue workers send the result of each table directory to",
+    )
+    parser.add_argument(
+        "--worker-idle-seconds",
+        type=int,
+        default=60,
+        help="Seconds a worker waits on an empty work queue before stopping",
+    )
+    parser.add_argument(
+        "--work-visibility-timeout",
+        type=int,
+        default=60,
+        help="Seconds a work unit is hidden from other workers, extended every "
+        "third of this while the unit is being tagged",
+    )
+    parser.add_argument(
+        "--coordinator-timeout-seconds",
+        type=int,
+        default=86400,
+        help="Seconds the coordinator waits for the results of every table directory",
+    )
+    parser.add_argument(
+        "--sqs-endpoint-url",
+        help="An alternative SQS endpoint, e.g. a local ElasticMQ",
+    )
+    parser.add_argument(
+        "--s3-endpoint-url",
+        help="An alternative S3 endpoint, such as a local stand-in for load testing",
+    )
+    parser.add_argument(
+        "--key-layout-location",
+        help="The local path or S3 location of a JSON file of key layout rules",
+    )
+    parser.add_argument(
+        "--profile",
+        default="none",
+        choices=["none", "cpu", "memory", "both"],
+        help="Profile the run with cProfile, tracemalloc or both",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default="s3_tagger_profile",
+        help="The local path or S3 location prefix to write profiling reports to",
+    )
+    parser.add_argument(
+        "--profile-snapshot-interval",
+        type=int,
+        default=0,
+        help="Seconds between interim profiling reports, 0 to only write them at exit",
+    )
 
     _args = parser.parse_args()
 
@@ -300,6 +2150,110 @@ def get_parameters():
     if "APPLICATION" in os.environ:
         _args.application = os.environ["APPLICATION"]
 
+    if "MODE" in os.environ:
+        _args.mode = os.environ["MODE"]
+
+    if "AUDIT_SAMPLE_SIZE" in os.environ:
+        _args.audit_sample_size = int(os.environ["AUDIT_SAMPLE_SIZE"])
+
+    if "AUDIT_CONFIDENCE" in os.environ:
+        _args.audit_confidence = float(os.environ["AUDIT_CONFIDENCE"])
+
+    if "AUDIT_RETAG" in os.environ:
+        _args.audit_retag = os.environ["AUDIT_RETAG"].lower() == "true"
+
+    if "DELTA" in os.environ:
+        _args.delta = os.environ["DELTA"].lower() == "true"
+
+    if "CSV_SNAPSHOT_LOCATION" in os.environ:
+        _args.csv_snapshot_location = os.environ["CSV_SNAPSHOT_LOCATION"]
+
+    if "LEDGER_PATH" in os.environ:
+        _args.ledger_path = os.environ["LEDGER_PATH"]
+
+    if "LEDGER_S3_LOCATION" in os.environ:
+        _args.ledger_s3_location = os.environ["LEDGER_S3_LOCATION"]
+
+    if "LEDGER_MAX_AGE_DAYS" in os.environ:
+        _args.ledger_max_age_days = int(os.environ["LEDGER_MAX_AGE_DAYS"])
+
+    if "HEDGE_PERCENTILE" in os.environ:
+        _args.hedge_percentile = float(os.environ["HEDGE_PERCENTILE"])
+
+    if "HEDGE_BUDGET" in os.environ:
+        _args.hedge_budget = float(os.environ["HEDGE_BUDGET"])
+
+    if "PROCESSES" in os.environ:
+        _args.processes = int(os.environ["PROCESSES"])
+
+    if "WORK_QUEUE_URL" in os.environ:
+        _args.work_queue_url = os.environ["WORK_QUEUE_URL"]
+
+    if "RESULTS_QUEUE_URL" in os.environ:
+        _args.results_queue_url = os.environ["RESULTS_QUEUE_URL"]
+
+    if "WORKER_IDLE_SECONDS" in os.environ:
+        _args.worker_idle_seconds = int(os.environ["WORKER_IDLE_SECONDS"])
+
+    if "WORK_VISIBILITY_TIMEOUT" in os.environ:
+        _args.work_visibility_timeout = int(os.environ["WORK_VISIBILITY_TIMEOUT"])
+
+    if "COORDINATOR_TIMEOUT_SECONDS" in os.environ:
+        _args.coordinator_timeout_seconds = int(
+            os.environ["COORDINATOR_TIMEOUT_SECONDS"]
+        )
+
+    if "SQS_ENDPOINT_URL" in os.environ:
+        _args.sqs_endpoint_url = os.environ["SQS_ENDPOINT_URL"]
+
+    if "S3_ENDPOINT_URL" in os.environ:
+        _args.s3_endpoint_url = os.environ["S3_ENDPOINT_URL"]
+
+    if "KEY_LAYOUT_LOCATION" in os.environ:
+        _args.key_layout_location = os.environ["KEY_LAYOUT_LOCATION"]
+
+    if "PROFILE" in os.environ:
+        _args.profile = os.environ["PROFILE"]
+
+    if "PROFILE_OUTPUT" in os.environ:
+        _args.profile_output = os.environ["PROFILE_OUTPUT"]
+
+    if "PROFILE_SNAPSHOT_INTERVAL" in os.environ:
+        _args.profile_snapshot_interval = int(os.environ["PROFILE_SNAPSHOT_INTERVAL"])
+
+    if not 0 < _args.audit_confidence < 1:
+        raise argparse.ArgumentError(
+            None,
+            "ArgumentError: audit_confidence must be between 0 and 1, got {}".format(
+                _args.audit_confidence
+            ),
+        )
+
+    if not 0 <= _args.hedge_percentile <= 100:
+        raise argparse.ArgumentError(
+            None,
+            "ArgumentError: hedge_percentile must be between 0 and 100, got {}".format(
+                _args.hedge_percentile
+            ),
+        )
+
+    if _args.hedge_budget < 0:
+        raise argparse.ArgumentError(
+            None,
+            "ArgumentError: hedge_budget must not be negative, got {}".format(
+                _args.hedge_budget
+            ),
+        )
+
+    if _args.csv_snapshot_location is None and None not in (
+        _args.csv_location,
+        _args.data_bucket,
+        _args.data_s3_prefix,
+    ):
+        _args.csv_snapshot_location = default_csv_snapshot_location(
+            _args.csv_location, _args.data_bucket, _args.data_s3_prefix
+        )
+
     required_args = ["csv_location", "data_bucket", "data_s3_prefix"]
     missing_args = []
 
@@ -307,6 +2261,14 @@ def get_parameters():
         if required_message_key not in _args:
             missing_args.append(required_message_key)
 
+    if _args.mode == "compact-ledger" and not _args.ledger_path:
+        missing_args.append("ledger_path")
+
+    if _args.mode in ("coordinate", "work"):
+        for queue_arg in ["work_queue_url", "results_queue_url"]:
+            if not getattr(_args, queue_arg):
+                missing_args.append(queue_arg)
+
     if missing_args:
         raise argparse.ArgumentError(
             None,
@@ -319,6 +2281,8 @@ def get_parameters():
 
 
 if __name__ == "__main__":
+    profiler = None
+    ledger = None
     try:
         args = get_parameters()
         logger = setup_logging(args.log_level)
@@ -329,39 +2293,196 @@ if __name__ == "__main__":
         )
 
         logger.info("Instantiating S3 client")
-        s3 = get_s3()
+        s3 = get_s3(args.s3_endpoint_url)
         logger.info("S3 client instantiated")
 
-        logger.info(
-            f'Fetching and reading CSV file", "csv_location": "{args.csv_location}'
-        )
-        csv_data = read_csv(args.csv_location, s3)
+        if args.profile != "none":
+            profiler = RunProfiler(args.profile, args.profile_output, s3)
+            profiler.start(args.profile_snapshot_interval)
+
+        if args.mode == "compact-ledger":
+            ledger = open_ledger(args.ledger_path, args.ledger_s3_location, s3)
+            rows_before, rows_after = ledger.compact(args.ledger_max_age_days)
+            logger.info(
+                f'Compacted tagging ledger", "ledger_path": "{args.ledger_path}", '
+                f'"rows_before": "{rows_before}", "rows_after": "{rows_after}", '
+                f'"ledger_max_age_days": "{args.ledger_max_age_days}'
+            )
+        else:
+            logger.info(
+                f'Fetching and reading CSV file", "csv_location": "{args.csv_location}'
+            )
+            csv_data = read_csv(args.csv_location, s3)
 
-        logger.info(
-            f'Getting list of objects to tag", "data_bucket": "{args.data_bucket}", '
-            f'"data_s3_prefix": "{args.data_s3_prefix}'
-        )
-        objects_to_tag = get_objects_in_prefix(
-            args.data_bucket, args.data_s3_prefix, s3
-        )
+            if args.key_layout_location:
+                key_layout_rules = read_key_layout_rules(args.key_layout_location, s3)
+            else:
+                key_layout_rules = DEFAULT_KEY_LAYOUT_RULES
+            key_layout = KeyLayout(csv_data, key_layout_rules)
 
-        logger.info(
-            f'Beginning to tag objects", "data_bucket": "{args.data_bucket}", '
-            f'"csv_location": "{args.csv_location}'
-        )
+            lists_table_directories = args.mode == "coordinate" or (
+                args.delta and args.mode == "tag"
+            )
+            if lists_table_directories and not rules_have_table_directories(
+                key_layout_rules
+            ):
+                logger.error(
+                    f"Delta and coordinate modes need every key layout rule to put {{table}} directly after {{db}}/ "
+                    f'as table directories are found by listing", "mode": "{args.mode}", '
+                    f'"key_layout_location": "{args.key_layout_location}'
+                )
+                sys.exit(-1)
+
+            hedger = None
+            if args.hedge_percentile > 0 and (
+                args.mode == "work" or (args.mode == "tag" and args.processes <= 1)
+            ):
+                hedger = RequestHedger(args.hedge_percentile, args.hedge_budget)
+
+            if args.mode == "coordinate":
+                coordinate_tagging(
+                    args.data_bucket,
+                    args.data_s3_prefix,
+                    s3,
+                    get_sqs(args.sqs_endpoint_url),
+                    args.work_queue_url,
+                    args.results_queue_url,
+                    key_layout,
+                    args.coordinator_timeout_seconds,
+                )
+            elif args.mode == "work":
+                process_work_units(
+                    args.data_bucket,
+                    s3,
+                    get_sqs(args.sqs_endpoint_url),
+                    args.work_queue_url,
+                    args.results_queue_url,
+                    csv_data,
+                    key_layout,
+                    args.worker_idle_seconds,
+                    hedger,
+                    args.work_visibility_timeout,
+                )
+            else:
+                etags = None
+                if args.ledger_path and args.mode == "tag":
+                    ledger = open_ledger(args.ledger_path, args.ledger_s3_location, s3)
+                    etags = {}
+
+                previous_csv_data = None
+                if args.delta and args.mode == "tag":
+                    previous_csv_data = read_csv_snapshot(
+                        args.csv_snapshot_location, s3
+                    )
 
-        logger.debug(
-            f'Verbose list of items found and will attempt to tag", "data_bucket": "{args.data_bucket}",'
-            f'"objects_to_tag": "{objects_to_tag}'
-        )
-        tag_path(objects_to_tag, s3, args.data_bucket, csv_data)
+                if previous_csv_data is not None:
+                    tables_to_tag = diff_csv_data(previous_csv_data, csv_data)
+                    logger.info(
+                        f'Getting list of objects in changed tables", "data_bucket": "{args.data_bucket}", '
+                        f'"data_s3_prefix": "{args.data_s3_prefix}", "number_of_tables": "{len(tables_to_tag)}'
+                    )
+                    objects_to_tag = get_objects_in_tables(
+                        args.data_bucket,
+                        args.data_s3_prefix,
+                        s3,
+                        tables_to_tag,
+                        csv_data,
+                        key_layout,
+                        etags,
+                    )
+                else:
+                    logger.info(
+                        f'Getting list of objects to tag", "data_bucket": "{args.data_bucket}", '
+                        f'"data_s3_prefix": "{args.data_s3_prefix}'
+                    )
+                    objects_to_tag = get_objects_in_prefix(
+                        args.data_bucket, args.data_s3_prefix, s3, etags
+                    )
 
-        logger.info(
-            f'Finished tagging objects", "data_bucket": "{args.data_bucket}, '
-            f'"data_s3_prefix": "{args.data_s3_prefix}"'
-            f'"csv_location": "{args.csv_location}'
-        )
+                if args.mode == "audit":
+                    logger.info(
+                        f'Beginning to audit objects", "data_bucket": "{args.data_bucket}", '
+                        f'"csv_location": "{args.csv_location}", "audit_sample_size": "{args.audit_sample_size}", '
+                        f'"audit_confidence": "{args.audit_confidence}", "audit_retag": "{args.audit_retag}'
+                    )
+                    audit_path(
+                        objects_to_tag,
+                        s3,
+                        args.data_bucket,
+                        csv_data,
+                        args.audit_sample_size,
+                        args.audit_confidence,
+                        args.audit_retag,
+                        key_layout,
+                    )
+
+                    logger.info(
+                        f'Finished auditing objects", "data_bucket": "{args.data_bucket}, '
+                        f'"data_s3_prefix": "{args.data_s3_prefix}"'
+                        f'"csv_location": "{args.csv_location}'
+                    )
+                else:
+                    logger.info(
+                        f'Beginning to tag objects", "data_bucket": "{args.data_bucket}", '
+                        f'"csv_location": "{args.csv_location}'
+                    )
+
+                    logger.debug(
+                        f'Verbose list of items found and will attempt to tag", "data_bucket": "{args.data_bucket}",'
+                        f'"objects_to_tag": "{objects_to_tag}'
+                    )
+                    if args.processes > 1:
+                        failed_objects_count = tag_path_multiprocess(
+                            objects_to_tag,
+                            args.data_bucket,
+                            csv_data,
+                            key_layout,
+                            args.processes,
+                            args.s3_endpoint_url,
+                            ledger,
+                            etags,
+                            args.hedge_percentile,
+                            args.hedge_budget,
+                        )
+                    else:
+                        failed_objects_count = tag_path(
+                            objects_to_tag,
+                            s3,
+                            args.data_bucket,
+                            csv_data,
+                            key_layout,
+                            ledger,
+                            etags,
+                            hedger,
+                        )
+
+                    if args.delta and failed_objects_count > 0:
+                        # Keep the old snapshot so the next delta run retries
+                        # the changed tables
+                        logger.error(
+                            f'Not updating CSV snapshot as objects failed to tag", '
+                            f'"csv_snapshot_location": "{args.csv_snapshot_location}", '
+                            f'"failed_objects_count": "{failed_objects_count}'
+                        )
+                    elif args.delta:
+                        write_csv_snapshot(
+                            args.csv_location, args.csv_snapshot_location, s3
+                        )
+
+                    logger.info(
+                        f'Finished tagging objects", "data_bucket": "{args.data_bucket}, '
+                        f'"data_s3_prefix": "{args.data_s3_prefix}"'
+                        f'"csv_location": "{args.csv_location}'
+                    )
+
+            if hedger is not None:
+                hedger.shutdown()
 
     except Exception as err:
         logger.error(f'Exception occurred for invocation", "error_message": "{err}')
         raise err
+    finally:
+        if ledger is not None:
+            close_ledger(ledger, args.ledger_s3_location, s3)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,155 @@
+import threading
+
+import boto3
+import botocore
+import pytest
+
+import fake_s3
+
+DATA_BUCKET = "fake-data-bucket"
+
+
+@pytest.fixture
+def fake_s3_server():
+    synthetic_keys = fake_s3.SyntheticKeys("partitioned", 2, 3, 4, 5)
+    state = fake_s3.FakeS3State(
+        DATA_BUCKET,
+        synthetic_keys,
+        fault_profiles={},
+        files={
+            ("fake-csv-bucket", "table_info.csv"): fake_s3.build_csv(synthetic_keys)
+        },
+    )
+    server = fake_s3.create_server(state)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_client(server, max_attempts=3):
+    return boto3.client(
+        "s3",
+        endpoint_url=f"http://127.0.0.1:{server.server_address[1]}",
+        aws_access_key_id="fake",
+        aws_secret_access_key="fake",
+        region_name="eu-west-2",
+        config=botocore.config.Config(
+            s3={"addressing_style": "path"},
+            retries={"max_attempts": max_attempts, "mode": "standard"},
+        ),
+    )
+
+
+def test_synthetic_keys_sort_in_index_order():
+    synthetic_keys = fake_s3.SyntheticKeys("hive", 3, 4, 5, 6)
+    keys = [synthetic_keys.key(index) for index in range(synthetic_keys.count)]
+
+    assert synthetic_keys.count == 360
+    assert keys == sorted(keys)
+    assert keys[0] == "data/db000.db/tab0000/dt=0000/part-00000"
+    assert synthetic_keys.first_index_at_or_after("data/db001.db/") == 120
+
+
+def test_list_objects_v2_pages_through_prefix(fake_s3_server):
+    s3_client = get_client(fake_s3_server)
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    keys = []
+    for page in paginator.paginate(
+        Bucket=DATA_BUCKET,
+        Prefix="data/db001.db/tab0002/",
+        PaginationConfig={"PageSize": 7},
+    ):
+        keys.extend(item["Key"] for item in page["Contents"])
+
+    assert len(keys) == 20
+    assert keys[0] == "data/db001.db/tab0002/partition000/part-00000"
+    assert keys[-1] == "data/db001.db/tab0002/partition003/part-00004"
+
+
+def test_object_tagging_round_trip(fake_s3_server):
+    s3_client = get_client(fake_s3_server)
+    key = "data/db000.db/tab0001/partition002/part-00003"
+
+    s3_client.put_object_tagging(
+        Bucket=DATA_BUCKET,
+        Key=key,
+        Tagging={"TagSet": [{"Key": "pii", "Value": "true"}]},
+    )
+    response = s3_client.get_object_tagging(Bucket=DATA_BUCKET, Key=key)
+
+    assert response["TagSet"] == [{"Key": "pii", "Value": "true"}]
+    with pytest.raises(botocore.exceptions.ClientError):
+        s3_client.put_object_tagging(
+            Bucket=DATA_BUCKET, Key="data/missing", Tagging={"TagSet": []}
+        )
+
+
+def test_get_object_serves_csv(fake_s3_server, tmp_path):
+    s3_client = get_client(fake_s3_server)
+    file_name = str(tmp_path / "table_info.csv")
+
+    s3_client.download_file("fake-csv-bucket", "table_info.csv", file_name)
+
+    with open(file_name) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "db,table,pii"
+    assert len(lines) == 7
+
+
+def test_throttling_is_injected_and_counted(fake_s3_server):
+    fake_s3_server.state.fault_profiles["put_object_tagging"] = fake_s3.FaultProfile(
+        throttle_rate=1.0
+    )
+    s3_client = get_client(fake_s3_server, max_attempts=2)
+
+    with pytest.raises(botocore.exceptions.ClientError) as error:
+        s3_client.put_object_tagging(
+            Bucket=DATA_BUCKET,
+            Key="data/db000.db/tab0000/partition000/part-00000",
+            Tagging={"TagSet": []},
+        )
+
+    stats = fake_s3_server.state.stats_summary()["put_object_tagging"]
+    assert error.value.response["Error"]["Code"] == "SlowDown"
+    assert stats["requests"] > 1, "Throttled request was not retried"
+    assert stats["retries"] == stats["requests"]
+
+
+def test_list_objects_v2_with_delimiter(fake_s3_server):
+    s3_client = get_client(fake_s3_server)
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    common_prefixes = []
+    for page in paginator.paginate(
+        Bucket=DATA_BUCKET,
+        Prefix="data/db001.db/",
+        Delimiter="/",
+        PaginationConfig={"PageSize": 2},
+    ):
+        assert "Contents" not in page
+        common_prefixes.extend(item["Prefix"] for item in page["CommonPrefixes"])
+
+    assert common_prefixes == [
+        "data/db001.db/tab0000/",
+        "data/db001.db/tab0001/",
+        "data/db001.db/tab0002/",
+    ]
+    stats = fake_s3_server.state.stats_summary()["list_objects_v2"]
+    assert stats["requests"] == 2
+
+
+def test_put_object_round_trip(fake_s3_server, tmp_path):
+    s3_client = get_client(fake_s3_server)
+    file_name = str(tmp_path / "snapshot.csv")
+    with open(file_name, "w") as f:
+        f.write("db,table,pii\n")
+
+    s3_client.upload_file(file_name, "fake-csv-bucket", "table_info.csv.snapshot")
+    response = s3_client.get_object(
+        Bucket="fake-csv-bucket", Key="table_info.csv.snapshot"
+    )
+
+    assert response["Body"].read() == b"db,table,pii\n"
@@ -1,9 +1,17 @@
+import cProfile
+import json
+import sys
+import threading
+import time
+import tracemalloc
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 import boto3
 import pytest
-from moto import mock_s3
+from moto import mock_s3, mock_sqs
 
+import fake_s3
 import s3_tagger
 
 with warnings.catch_warnings():
@@ -333,20 +341,21 @@ def test_tag_object_unrecognised_key_for_database_and_table_name_length_three():
     s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
 
     tag_result = s3_tagger.tag_object(key, s3_client, BUCKET_TO_TAG, csv_data)
-    error_call_count = s3_tagger.logger.warning.call_count
+    call_count = s3_tagger.logger.warning.call_count
 
-    s3_tagger.logger.error.assert_has_calls(
+    s3_tagger.logger.warning.assert_has_calls(
         [
             mock.call(log)
             for log in [
-                f'Caught exception when attempting to establish database name from key. Not tagging and continuing on", "key": "{key}", "exception": "list index out of range',
+                f'Couldn\'t establish a valid database and table name for key ", "table_name": "", "db_name": "", "key": "{key}',
             ]
         ]
     )
 
     assert (
-        not error_call_count > 1
-    ), f"Expected logger.error to only be called twice, called {error_call_count} times"
+        not call_count > 1
+    ), f"Expected logger.warning to only be called once, called {call_count} times"
+    assert not s3_tagger.logger.error.called
     assert tag_result == 0, f"Expected tag_object to return 0, got: {tag_result}"
 
 
@@ -569,6 +578,993 @@ def test_tag_folder(csv_data):
     assert response5["TagSet"][2]["Value"] == "true", "Object was not tagged correctly"
 
 
+@mock_s3
+def test_audit_path_detects_drift_and_retags(csv_data):
+    objects_to_audit = [
+        "data/db1/tab1/00000_0",
+        "data/db1/tab1/00001_0",
+        "data/db2/tab2/00000_0",
+    ]
+
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in objects_to_audit:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    s3_tagger.tag_path(objects_to_audit[:2], s3_client, BUCKET_TO_TAG, csv_data)
+
+    results = s3_tagger.audit_path(
+        objects_to_audit,
+        s3_client,
+        BUCKET_TO_TAG,
+        csv_data,
+        sample_size=10,
+        confidence=0.95,
+        retag=True,
+    )
+
+    assert results[("db1", "tab1")]["drifted"] == 0
+    assert results[("db1", "tab1")]["sampled"] == 2
+    assert results[("db2", "tab2")]["drifted"] == 1
+    assert results[("db2", "tab2")]["drift_lower_bound"] == 1.0
+
+    response = s3_client.get_object_tagging(
+        Bucket=BUCKET_TO_TAG, Key="data/db2/tab2/00000_0"
+    )
+    assert response["TagSet"][2]["Value"] == "true", "Object was not retagged"
+
+
+@mock_s3
+def test_audit_path_samples_per_table(csv_data):
+    objects_to_audit = [f"data/db1/tab1/0000{index}_0" for index in range(6)]
+
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in objects_to_audit:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    results = s3_tagger.audit_path(
+        objects_to_audit,
+        s3_client,
+        BUCKET_TO_TAG,
+        csv_data,
+        sample_size=3,
+        confidence=0.95,
+    )
+
+    assert results[("db1", "tab1")]["population"] == 6
+    assert results[("db1", "tab1")]["sampled"] == 3
+    assert results[("db1", "tab1")]["drifted"] == 3
+    assert 0 < results[("db1", "tab1")]["drift_lower_bound"] < 1
+    response = s3_client.get_object_tagging(
+        Bucket=BUCKET_TO_TAG, Key=objects_to_audit[0]
+    )
+    assert len(response["TagSet"]) == 0, "Object should not be retagged"
+
+
+def test_drift_confidence_bounds():
+    lower, upper = s3_tagger.drift_confidence_bounds(0, 20, 1000, 0.95)
+    assert lower == pytest.approx(0.0)
+    assert 0.1 < upper < 0.2
+
+    lower, upper = s3_tagger.drift_confidence_bounds(2, 4, 4, 0.95)
+    assert lower == upper == 0.5
+
+
+def test_stratified_drift_bounds():
+    # Every sampled table is clean, the unchecked table may be fully drifted
+    estimate, lower, upper = s3_tagger.stratified_drift_bounds(
+        [(0, 20, 1000), (0, 20, 1000), (0, 0, 50)], 0.95
+    )
+    assert estimate == lower == 0
+    assert upper == 50
+
+    estimate, lower, upper = s3_tagger.stratified_drift_bounds(
+        [(2, 20, 1000), (5, 10, 100), (1, 4, 4)], 0.95
+    )
+    assert estimate == pytest.approx(100 + 50 + 1)
+    assert 8 <= lower < estimate < upper
+
+    # The interval for the total is narrower than summing per-table bounds
+    summed_upper = sum(
+        s3_tagger.drift_confidence_bounds(drifted, sampled, population, 0.95)[1]
+        * population
+        for drifted, sampled, population in [(2, 20, 1000), (5, 10, 100), (1, 4, 4)]
+    )
+    assert upper < summed_upper
+
+
+@pytest.mark.parametrize(
+    "invalid_args",
+    [
+        ["--audit-confidence", "95"],
+        ["--audit-confidence", "0"],
+        ["--hedge-percentile", "150"],
+        ["--hedge-percentile", "-1"],
+        ["--hedge-budget", "-0.1"],
+    ],
+)
+def test_get_parameters_rejects_values_out_of_range(invalid_args):
+    argv = [
+        "s3_tagger.py",
+        "--csv-location",
+        CSV_LOCATION,
+        "--data-bucket",
+        BUCKET_TO_TAG,
+        "--data-s3-prefix",
+        DATA_S3_PREFIX,
+    ] + invalid_args
+    with mock.patch.object(sys, "argv", argv):
+        with pytest.raises(s3_tagger.argparse.ArgumentError):
+            s3_tagger.get_parameters()
+
+
+def test_run_profiler_writes_cpu_and_memory_reports(tmp_path):
+    s3_tagger.logger = mock.MagicMock()
+    output_location = str(tmp_path / "profile")
+
+    profiler = s3_tagger.RunProfiler(
+        "both", output_location, s3_client=None, top_count=1000
+    )
+    profiler.start()
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(s3_tagger.build_tag_set, ["db1"], ["tab1"], ["true"]))
+    profiler.stop()
+
+    cpu_report = (tmp_path / "profile.cpu.txt").read_text()
+    memory_report = (tmp_path / "profile.memory.txt").read_text()
+    assert (tmp_path / "profile.cpu.prof").exists()
+    assert "build_tag_set" in cpu_report, "Worker thread was not profiled"
+    assert "Peak traced memory" in memory_report
+
+
+def test_run_profiler_stop_freezes_threads_that_outlive_it(tmp_path):
+    s3_tagger.logger = mock.MagicMock()
+    profiler = s3_tagger.RunProfiler("cpu", str(tmp_path / "profile"), None)
+    stopped = threading.Event()
+
+    def outlive_profiler():
+        s3_tagger.build_tag_set("db1", "tab1", "true")
+        stopped.wait(5)
+        for _ in range(100):
+            s3_tagger.build_tag_set("db1", "tab1", "true")
+
+    profiler.start()
+    thread = threading.Thread(target=outlive_profiler)
+    thread.start()
+    profiler.stop()
+    stopped.set()
+    thread.join()
+
+    def build_tag_set_calls():
+        return sum(
+            stat[0]
+            for (_, _, function_name), stat in profiler._cpu_stats().stats.items()
+            if function_name == "build_tag_set"
+        )
+
+    assert profiler.cpu_profiles_stopped
+    assert build_tag_set_calls() <= 1
+    profiler.write_reports("-after-stop")
+    assert build_tag_set_calls() <= 1
+
+
+def test_run_profiler_skips_threads_it_cannot_profile(tmp_path):
+    s3_tagger.logger = mock.MagicMock()
+    profiler = s3_tagger.RunProfiler("cpu", str(tmp_path / "profile"), None)
+
+    class ActiveProfile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    with mock.patch.object(s3_tagger.cProfile, "Profile", ActiveProfile):
+        thread = threading.Thread(
+            target=profiler._profile_new_thread, args=(None, "call", None)
+        )
+        thread.start()
+        thread.join()
+
+    assert profiler.cpu_profiles == []
+    s3_tagger.logger.warning.assert_called_once()
+
+
+@mock_s3
+def test_run_profiler_uploads_reports_to_s3():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=TABLE_INFO_BUCKET,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+
+    profiler = s3_tagger.RunProfiler(
+        "memory", f"s3://{TABLE_INFO_BUCKET}/profiles/run", s3_client
+    )
+    profiler.start()
+    profiler.stop()
+
+    response = s3_client.list_objects_v2(Bucket=TABLE_INFO_BUCKET, Prefix="profiles/")
+    assert [item["Key"] for item in response["Contents"]] == ["profiles/run.memory.txt"]
+
+
+def test_key_layout_resolves_deep_hive_partitions(csv_data):
+    key_layout = s3_tagger.KeyLayout(csv_data)
+
+    matched = key_layout.match("data/db1.db/tab1/dt=2021-01-01/hr=01/part-0000")
+
+    assert matched == ("db1", "tab1", {"dt": "2021-01-01", "hr": "01"})
+
+
+def test_key_layout_prefers_database_closest_to_end_of_key(csv_data):
+    key_layout = s3_tagger.KeyLayout(csv_data)
+
+    assert key_layout.match("data/db2/db1/tab1/00000_0") == ("db1", "tab1", {})
+    assert key_layout.match("data/db1/tab1.db_$folder$") == ("db1", "tab1", {})
+    assert key_layout.match("data/db4/tab4/00000_0") is None
+
+
+def test_key_layout_custom_rules(csv_data):
+    key_layout = s3_tagger.KeyLayout(csv_data, ["{db}/tables/{table}/{any}"])
+
+    assert key_layout.match("data/db2/tables/tab2/00000_0") == ("db2", "tab2", {})
+    assert key_layout.match("data/db2/tab2/00000_0") is None
+
+
+def test_key_layout_invalid_rule(csv_data):
+    with pytest.raises(ValueError):
+        s3_tagger.KeyLayout(csv_data, ["{db}/{any}"])
+
+    with pytest.raises(ValueError):
+        s3_tagger.KeyLayout(csv_data, ["{db}/{table}/{unknown}"])
+
+
+def test_rules_have_table_directories():
+    assert s3_tagger.rules_have_table_directories(s3_tagger.DEFAULT_KEY_LAYOUT_RULES)
+    assert not s3_tagger.rules_have_table_directories(
+        ["{db}/{table}", "{db}/tables/{table}/{any}"]
+    )
+    assert not s3_tagger.rules_have_table_directories(["{db}/{table}_{any}"])
+
+
+@mock_s3
+def test_read_key_layout_rules():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=TABLE_INFO_BUCKET,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.put_object(
+        Body='{"rules": ["{db}/{table}/{partitions}/{any}"]}',
+        Bucket=TABLE_INFO_BUCKET,
+        Key="layout/key_layout.json",
+    )
+
+    rules = s3_tagger.read_key_layout_rules(
+        f"s3://{TABLE_INFO_BUCKET}/layout/key_layout.json", s3_client
+    )
+
+    assert rules == ["{db}/{table}/{partitions}/{any}"]
+
+
+@mock_s3
+def test_tag_path_for_deep_hive_partition(csv_data):
+    key = "data/db2.db/tab2/dt=2021-01-01/hr=01/part-0000"
+
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    s3_tagger.tag_path([key], s3_client, BUCKET_TO_TAG, csv_data)
+
+    response = s3_client.get_object_tagging(Bucket=BUCKET_TO_TAG, Key=key)
+    assert response["TagSet"][0]["Value"] == "db2", "Object was not tagged correctly"
+    assert response["TagSet"][1]["Value"] == "tab2", "Object was not tagged correctly"
+    assert response["TagSet"][2]["Value"] == "true", "Object was not tagged correctly"
+
+
+def test_diff_csv_data(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    previous_csv_data = {
+        "db1": [{"table": "tab1", "pii": "false"}, {"table": "tab3", "pii": "true"}],
+        "db2": [{"table": "tab2", "pii": ""}],
+        "db3": [{"table": "tab3", "pii": ""}, {"table": "tab5", "pii": "true"}],
+    }
+
+    tables_to_tag = s3_tagger.diff_csv_data(previous_csv_data, csv_data)
+
+    assert tables_to_tag == [("db1", "tab3"), ("db2", "tab2"), ("db3", "tab4")]
+
+
+@mock_s3
+def test_get_objects_in_tables(csv_data):
+    keys = [
+        "data/2021-01-28/db1.db/tab1/00000_0",
+        "data/2021-01-28/db1.db/tab1_$folder$",
+        "data/2021-01-28/db1.db/tab10/00000_0",
+        "data/2021-01-28/db1.db/tab3/00000_0",
+        "data/2021-01-28/db2.db/tab2/partition1/00000_0",
+        "data/2021-01-28/db3.db/tab4/00000_0",
+    ]
+
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in keys:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    objects_in_tables = s3_tagger.get_objects_in_tables(
+        BUCKET_TO_TAG, "data/", s3_client, [("db1", "tab1"), ("db2", "tab2")], csv_data
+    )
+
+    assert sorted(objects_in_tables) == [
+        "data/2021-01-28/db1.db/tab1/00000_0",
+        "data/2021-01-28/db1.db/tab1_$folder$",
+        "data/2021-01-28/db2.db/tab2/partition1/00000_0",
+    ]
+
+
+@mock_s3
+def test_find_table_directories_for_prefix_inside_database():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+
+    table_directories = s3_tagger.find_table_directories(
+        BUCKET_TO_TAG,
+        "/data/db1/tab",
+        s3_client,
+        [("db1", "tab1"), ("db1", "other"), ("db2", "tab2")],
+    )
+
+    assert table_directories == ["data/db1/tab1"]
+
+
+@mock_s3
+def test_find_table_directories_stops_at_unchanged_databases():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.put_object(
+        Body="testcontent", Bucket=BUCKET_TO_TAG, Key="data/db1.db/tab1/00000_0"
+    )
+    for table in range(5):
+        for day in range(5):
+            s3_client.put_object(
+                Body="testcontent",
+                Bucket=BUCKET_TO_TAG,
+                Key=f"data/db2.db/tab{table}/dt=2021-01-0{day}/hour=00/00000_0",
+            )
+
+    with mock.patch.object(
+        s3_tagger, "get_common_prefixes", wraps=s3_tagger.get_common_prefixes
+    ) as get_common_prefixes:
+        table_directories = s3_tagger.find_table_directories(
+            BUCKET_TO_TAG,
+            "data/",
+            s3_client,
+            [("db1", "tab1")],
+            db_names=["db1", "db2"],
+        )
+
+    assert table_directories == ["data/db1.db/tab1"]
+    assert get_common_prefixes.call_count == 1
+
+
+@mock_s3
+def test_get_objects_in_tables_lists_directories_below_depth_limit(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    deep_prefix = "a/b/c/d/e/f/"
+    for key in ["db1/tab1/00000_0", "db1/tab3/00000_0", "db2/tab2/00000_0"]:
+        s3_client.put_object(
+            Body="testcontent", Bucket=BUCKET_TO_TAG, Key=deep_prefix + key
+        )
+
+    objects_in_tables = s3_tagger.get_objects_in_tables(
+        BUCKET_TO_TAG, "", s3_client, [("db1", "tab1")], csv_data
+    )
+
+    assert objects_in_tables == [deep_prefix + "db1/tab1/00000_0"]
+    s3_tagger.logger.error.assert_called_once()
+
+    with pytest.raises(RuntimeError):
+        s3_tagger.build_work_units(
+            BUCKET_TO_TAG, "", s3_client, s3_tagger.KeyLayout(csv_data), "run"
+        )
+
+
+@mock_s3
+def test_csv_snapshot_round_trip():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=TABLE_INFO_BUCKET,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.upload_file(
+        "test_data.csv", TABLE_INFO_BUCKET, "table/info/path/test_data.csv"
+    )
+    csv_location = f"s3://{TABLE_INFO_BUCKET}/table/info/path/test_data.csv"
+    snapshot_location = f"{csv_location}.snapshot"
+
+    assert s3_tagger.read_csv_snapshot(snapshot_location, s3_client) is None
+
+    s3_tagger.write_csv_snapshot(csv_location, snapshot_location, s3_client)
+    snapshot = s3_tagger.read_csv_snapshot(snapshot_location, s3_client)
+
+    assert snapshot["db2"] == [{"table": "tab2", "pii": "true"}]
+
+
+@mock_s3
+def test_csv_snapshot_per_prefix_sharing_one_csv():
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=TABLE_INFO_BUCKET,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.upload_file(
+        "test_data.csv", TABLE_INFO_BUCKET, "table/info/path/test_data.csv"
+    )
+    csv_location = f"s3://{TABLE_INFO_BUCKET}/table/info/path/test_data.csv"
+
+    argv = [
+        "s3_tagger.py",
+        "--csv-location",
+        csv_location,
+        "--data-bucket",
+        BUCKET_TO_TAG,
+        "--data-s3-prefix",
+        "/data/db1/",
+        "--delta",
+    ]
+    with mock.patch.object(sys, "argv", argv):
+        args = s3_tagger.get_parameters()
+    first_prefix_snapshot = args.csv_snapshot_location
+    second_prefix_snapshot = s3_tagger.default_csv_snapshot_location(
+        csv_location, BUCKET_TO_TAG, "data/db2/"
+    )
+
+    assert first_prefix_snapshot == s3_tagger.default_csv_snapshot_location(
+        csv_location, BUCKET_TO_TAG, "data/db1/"
+    )
+    assert first_prefix_snapshot.startswith(f"{csv_location}.{BUCKET_TO_TAG}.")
+    assert first_prefix_snapshot != second_prefix_snapshot
+
+    # The run on the first prefix finishing must not hide the changes from
+    # the run on the second prefix
+    s3_tagger.write_csv_snapshot(csv_location, first_prefix_snapshot, s3_client)
+    assert s3_tagger.read_csv_snapshot(first_prefix_snapshot, s3_client) is not None
+    assert s3_tagger.read_csv_snapshot(second_prefix_snapshot, s3_client) is None
+
+
+@mock_s3
+def test_tag_path_with_ledger_skips_unchanged_objects(
+    objects_to_tag, csv_data, tmp_path
+):
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in objects_to_tag:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    ledger = s3_tagger.TaggingLedger(str(tmp_path / "ledger.sqlite"))
+    etags = {}
+    s3_tagger.get_objects_in_prefix(BUCKET_TO_TAG, "data/", s3_client, etags)
+    s3_tagger.tag_path(
+        objects_to_tag, s3_client, BUCKET_TO_TAG, csv_data, ledger=ledger, etags=etags
+    )
+    assert ledger.recorded_count == 2
+
+    changed_csv_data = dict(csv_data, db2=[{"table": "tab2", "pii": "false"}])
+    s3_tagger.logger = mock.MagicMock()
+    s3_tagger.tag_path(
+        objects_to_tag,
+        s3_client,
+        BUCKET_TO_TAG,
+        changed_csv_data,
+        ledger=ledger,
+        etags=etags,
+    )
+    ledger.close()
+
+    s3_tagger.logger.info.assert_any_call(
+        'Skipping objects already tagged with the same tags", "skipped_unchanged_count": "1'
+    )
+    s3_tagger.logger.info.assert_any_call(
+        f'Successfully tagged", "object": "{objects_to_tag[1]}'
+    )
+    response = s3_client.get_object_tagging(Bucket=BUCKET_TO_TAG, Key=objects_to_tag[1])
+    assert response["TagSet"][2]["Value"] == "false", "Changed object was not retagged"
+
+
+def test_tagging_ledger_unchanged_keys_and_compact(tmp_path):
+    ledger = s3_tagger.TaggingLedger(str(tmp_path / "ledger.sqlite"), batch_size=2)
+    ledger.record("data/db1/tab1/00000_0", '"etag1"', "hash1")
+    ledger.record("data/db1/tab1/00001_0", '"etag2"', "hash1")
+    ledger.record("data/db1/tab1/00002_0", '"etag3"', "hash1")
+    ledger.flush()
+
+    unchanged = ledger.unchanged_keys(
+        [
+            ("data/db1/tab1/00000_0", '"etag1"', "hash1"),
+            ("data/db1/tab1/00001_0", '"etag2-new"', "hash1"),
+            ("data/db1/tab1/00002_0", '"etag3"', "hash2"),
+            ("data/db1/tab1/00003_0", '"etag4"', "hash1"),
+        ]
+    )
+    assert unchanged == {"data/db1/tab1/00000_0"}
+
+    assert ledger.compact(max_age_days=1) == (3, 3)
+    assert ledger.compact(max_age_days=-1) == (3, 0)
+    ledger.close()
+
+
+def test_prioritise_objects(csv_data):
+    objects_to_tag = [
+        "data/db1/tab1/00000_0",
+        "data/db3/tab3/00000_0",
+        "data/db2/tab2/00000_0",
+        "data/db1/tab9/00000_0",
+        "data/db3/tab4/00000_0",
+    ]
+
+    prioritised_objects = s3_tagger.prioritise_objects(
+        objects_to_tag, csv_data, s3_tagger.KeyLayout(csv_data)
+    )
+
+    assert prioritised_objects == {
+        "true": ["data/db2/tab2/00000_0", "data/db3/tab4/00000_0"],
+        "false": ["data/db1/tab1/00000_0"],
+        "unclassified": ["data/db3/tab3/00000_0", "data/db1/tab9/00000_0"],
+    }
+
+
+@mock_s3
+def test_tag_path_reports_priority_completion(objects_to_tag, csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in objects_to_tag:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    s3_tagger.tag_path(objects_to_tag, s3_client, BUCKET_TO_TAG, csv_data)
+
+    completion_logs = [
+        call.args[0]
+        for call in s3_tagger.logger.info.call_args_list
+        if call.args[0].startswith('Finished tagging priority"')
+    ]
+    assert [log.split('"')[4] for log in completion_logs] == ["true", "false"]
+    assert '"number_of_objects": "1"' in completion_logs[0]
+
+
+def test_request_hedger_sends_hedge_for_slow_request():
+    hedger = s3_tagger.RequestHedger(50, 1.0, min_samples=5, recompute_every=1)
+    for _ in range(5):
+        hedger.call(lambda value: value, value="warm")
+
+    release_primary = threading.Event()
+    calls = []
+
+    def slow_then_fast(value):
+        calls.append(value)
+        if len(calls) == 1:
+            release_primary.wait(5)
+            return "primary"
+        return "hedge"
+
+    assert hedger.call(slow_then_fast, value="tag") == "hedge"
+    release_primary.set()
+    assert hedger.hedges_sent == 1
+    assert hedger.hedges_won == 1
+    hedger.shutdown()
+
+
+def test_request_hedger_respects_budget():
+    hedger = s3_tagger.RequestHedger(50, 0, min_samples=5, recompute_every=1)
+    for _ in range(5):
+        hedger.call(lambda value: value, value="warm")
+
+    def slow(value):
+        time.sleep(0.05)
+        return value
+
+    assert hedger.call(slow, value="tag") == "tag"
+    assert hedger.requests == 6
+    assert hedger.hedges_sent == 0
+    hedger.shutdown()
+
+
+def create_work_queues():
+    sqs_client = boto3.client("sqs", region_name="eu-west-2")
+    work_queue_url = sqs_client.create_queue(QueueName="s3-tagger-work")["QueueUrl"]
+    results_queue_url = sqs_client.create_queue(QueueName="s3-tagger-results")[
+        "QueueUrl"
+    ]
+    return sqs_client, work_queue_url, results_queue_url
+
+
+@mock_s3
+def test_build_work_units_queues_pii_tables_first(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in [
+        "data/db1/tab1/00000_0",
+        "data/db2/tab2/00000_0",
+        "data/db3.db/tab3/00000_0",
+        "data/db3.db/tab4.db/00000_0",
+        "data/db1/tab9/00000_0",
+    ]:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+
+    work_units = s3_tagger.build_work_units(
+        BUCKET_TO_TAG, "data/", s3_client, s3_tagger.KeyLayout(csv_data), "run1"
+    )
+
+    assert [work_unit["table_directory"] for work_unit in work_units] == [
+        "data/db2/tab2",
+        "data/db3.db/tab4.db",
+        "data/db1/tab1",
+        "data/db1/tab9",
+        "data/db3.db/tab3",
+    ]
+    assert work_units[1]["table"] == "tab4"
+    s3_tagger.logger.warning.assert_called_once_with(
+        'Found table directories for tables missing from the CSV", '
+        '"number_of_tables": "1", "tables": "[(\'db1\', \'tab9\')]'
+    )
+    assert work_units[0] == {
+        "run_id": "run1",
+        "unit_id": "0",
+        "db": "db2",
+        "table": "tab2",
+        "table_directory": "data/db2/tab2",
+    }
+
+
+@mock_sqs
+@mock_s3
+def test_coordinate_tagging_with_worker(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    sqs_client, work_queue_url, results_queue_url = create_work_queues()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    objects_to_tag = [
+        "data/db1/tab1/00000_0",
+        "data/db1/tab1/00001_0",
+        "data/db1/tab10/00000_0",
+        "data/db2/tab2/00000_0",
+    ]
+    for key in objects_to_tag:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+    key_layout = s3_tagger.KeyLayout(csv_data)
+    hedger = s3_tagger.RequestHedger(50, 1.0)
+
+    with ThreadPoolExecutor() as executor:
+        coordinator = executor.submit(
+            s3_tagger.coordinate_tagging,
+            BUCKET_TO_TAG,
+            "data/",
+            s3_client,
+            sqs_client,
+            work_queue_url,
+            results_queue_url,
+            key_layout,
+            30,
+        )
+        work_units_processed = s3_tagger.process_work_units(
+            BUCKET_TO_TAG,
+            s3_client,
+            sqs_client,
+            work_queue_url,
+            results_queue_url,
+            csv_data,
+            key_layout,
+            1,
+            hedger,
+        )
+        tagged_objects_count = coordinator.result()
+
+    assert work_units_processed == 3
+    assert tagged_objects_count == 3
+    s3_tagger.logger.info.assert_any_call('Tagged", "objects_tagged_count": "3')
+    # Reported by the worker as it stops and aggregated by the coordinator,
+    # tab10 is tagged but missing from the CSV so not in the tagged count
+    s3_tagger.logger.info.assert_any_call(
+        'Hedged request report", "requests": "4", "hedges_sent": "0", "hedges_won": "0", '
+        '"hedge_percentile": "50", "hedge_budget": "1.0", "hedge_delay_seconds": "'
+    )
+    s3_tagger.logger.info.assert_any_call(
+        'Hedged request report", "requests": "4", "hedges_sent": "0", "hedges_won": "0'
+    )
+    response = s3_client.get_object_tagging(
+        Bucket=BUCKET_TO_TAG, Key="data/db1/tab1/00001_0"
+    )
+    assert response["TagSet"][1]["Value"] == "tab1"
+    response = s3_client.get_object_tagging(
+        Bucket=BUCKET_TO_TAG, Key="data/db1/tab10/00000_0"
+    )
+    assert response["TagSet"][1]["Value"] == "tab10"
+    assert response["TagSet"][2]["Value"] == ""
+
+
+@mock_sqs
+def test_process_work_units_extends_visibility_while_tagging(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    sqs_client, work_queue_url, results_queue_url = create_work_queues()
+    s3_tagger.send_work_units(
+        [
+            {
+                "run_id": "run1",
+                "unit_id": "0",
+                "db": "db1",
+                "table": "tab1",
+                "table_directory": "data/db1/tab1",
+            }
+        ],
+        sqs_client,
+        work_queue_url,
+    )
+
+    def slow_tag_work_unit(*args):
+        time.sleep(2.5)
+        return 1, 1, 0
+
+    with mock.patch.object(
+        s3_tagger, "tag_work_unit", side_effect=slow_tag_work_unit
+    ), mock.patch.object(
+        sqs_client,
+        "change_message_visibility",
+        wraps=sqs_client.change_message_visibility,
+    ) as change_message_visibility:
+        work_units_processed = s3_tagger.process_work_units(
+            BUCKET_TO_TAG,
+            None,
+            sqs_client,
+            work_queue_url,
+            results_queue_url,
+            csv_data,
+            s3_tagger.KeyLayout(csv_data),
+            0,
+            visibility_timeout=3,
+        )
+
+    assert work_units_processed == 1
+    assert change_message_visibility.call_count >= 2
+    assert change_message_visibility.call_args.kwargs["VisibilityTimeout"] == 3
+
+
+@mock_s3
+@mock_sqs
+def test_coordinate_tagging_reports_failed_work_units(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    sqs_client, work_queue_url, results_queue_url = create_work_queues()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    for key in ["data/db1/tab1/00000_0", "data/db2/tab2/00000_0"]:
+        s3_client.put_object(Body="testcontent", Bucket=BUCKET_TO_TAG, Key=key)
+    key_layout = s3_tagger.KeyLayout(csv_data)
+    tag_work_unit = s3_tagger.tag_work_unit
+
+    def failing_tag_work_unit(work_unit, *args):
+        if work_unit["table"] == "tab2":
+            raise RuntimeError("Access Denied")
+        return tag_work_unit(work_unit, *args)
+
+    with ThreadPoolExecutor() as executor, mock.patch.object(
+        s3_tagger, "tag_work_unit", side_effect=failing_tag_work_unit
+    ):
+        coordinator = executor.submit(
+            s3_tagger.coordinate_tagging,
+            BUCKET_TO_TAG,
+            "data/",
+            s3_client,
+            sqs_client,
+            work_queue_url,
+            results_queue_url,
+            key_layout,
+            30,
+        )
+        work_units_processed = s3_tagger.process_work_units(
+            BUCKET_TO_TAG,
+            s3_client,
+            sqs_client,
+            work_queue_url,
+            results_queue_url,
+            csv_data,
+            key_layout,
+            1,
+        )
+        tagged_objects_count = coordinator.result()
+
+    # The worker carries on past the failed unit and the coordinator finishes
+    assert work_units_processed == 2
+    assert tagged_objects_count == 1
+    s3_tagger.logger.error.assert_any_call(
+        'Work units failed to tag", "failed_work_units_count": "1", "number_of_work_units": "2'
+    )
+
+
+@mock_sqs
+def test_collect_work_results_leaves_other_runs_and_ignores_duplicates():
+    s3_tagger.logger = mock.MagicMock()
+    sqs_client, _, results_queue_url = create_work_queues()
+    for run_id, unit_id, worker_id in [
+        ("run0", "0", "worker1"),
+        ("run1", "0", "worker1"),
+        ("run1", "0", "worker2"),
+        ("run1", "1", "worker2"),
+    ]:
+        sqs_client.send_message(
+            QueueUrl=results_queue_url,
+            MessageBody=json.dumps(
+                {
+                    "run_id": run_id,
+                    "unit_id": unit_id,
+                    "worker_id": worker_id,
+                    "number_of_objects": 1,
+                    "objects_tagged_count": 1,
+                }
+            ),
+        )
+
+    results = s3_tagger.collect_work_results(
+        sqs_client, results_queue_url, "run1", {"0", "1"}, 5
+    )
+
+    assert sorted(result["unit_id"] for result in results) == ["0", "1"]
+
+    # The result of the other run is left for its own coordinator
+    results = s3_tagger.collect_work_results(
+        sqs_client, results_queue_url, "run0", {"0"}, 5
+    )
+    assert [result["worker_id"] for result in results] == ["worker1"]
+    with pytest.raises(RuntimeError):
+        s3_tagger.collect_work_results(
+            sqs_client, results_queue_url, "run1", {"0", "1", "2"}, 1
+        )
+
+
+def test_partition_objects_by_table(csv_data):
+    objects_to_tag = (
+        [f"data/db1/tab1/{part:05d}_0" for part in range(6)]
+        + [f"data/db2/tab2/{part:05d}_0" for part in range(2)]
+        + [f"data/db3/tab4/{part:05d}_0" for part in range(2)]
+    )
+
+    partitions = s3_tagger.partition_objects_by_table(
+        objects_to_tag, csv_data, s3_tagger.KeyLayout(csv_data), 2
+    )
+
+    assert sorted(len(partition) for partition in partitions) == [5, 5]
+    assert sorted(sum(partitions, [])) == sorted(objects_to_tag)
+    assert any(
+        set(partition) == {f"data/db1/tab1/{part:05d}_0" for part in range(5)}
+        for partition in partitions
+    )
+
+
+def test_stop_inherited_profiling():
+    thread_profiles = []
+
+    def profile_in_thread():
+        thread_profiles.append(sys.getprofile())
+
+    profile = cProfile.Profile()
+    threading.setprofile(lambda frame, event, arg: None)
+    profile.enable()
+    tracemalloc.start()
+    s3_tagger.stop_inherited_profiling()
+    thread = threading.Thread(target=profile_in_thread)
+    thread.start()
+    thread.join()
+
+    assert sys.getprofile() is None
+    assert thread_profiles == [None]
+    assert not tracemalloc.is_tracing()
+
+
+def test_tag_path_multiprocess():
+    synthetic_keys = fake_s3.SyntheticKeys("partitioned", 2, 3, 2, 5)
+    state = fake_s3.FakeS3State(BUCKET_TO_TAG, synthetic_keys, fault_profiles={})
+    server = fake_s3.create_server(state)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    endpoint_url = f"http://127.0.0.1:{server.server_address[1]}"
+    csv_data = {
+        f"db{db:03d}": [
+            {"table": f"tab{table:04d}", "pii": "true"} for table in range(3)
+        ]
+        for db in range(2)
+    }
+    objects_to_tag = [
+        synthetic_keys.key(index) for index in range(synthetic_keys.count)
+    ]
+
+    s3_tagger.logger = mock.MagicMock()
+    with mock.patch.dict(
+        "os.environ", {"AWS_ACCESS_KEY_ID": "fake", "AWS_SECRET_ACCESS_KEY": "fake"}
+    ):
+        s3_tagger.tag_path_multiprocess(
+            objects_to_tag,
+            BUCKET_TO_TAG,
+            csv_data,
+            s3_tagger.KeyLayout(csv_data),
+            3,
+            endpoint_url,
+        )
+    server.shutdown()
+    server.server_close()
+
+    assert len(state.tags) == 60
+    assert state.stats["put_object_tagging"]["requests"] == 60
+    s3_tagger.logger.info.assert_any_call('Tagged", "objects_tagged_count": "60')
+
+
+@mock_s3
+def test_tag_path_reports_failed_objects(csv_data):
+    s3_tagger.logger = mock.MagicMock()
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(
+        Bucket=BUCKET_TO_TAG,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    s3_client.put_object(
+        Body="testcontent", Bucket=BUCKET_TO_TAG, Key="data/db1/tab1/00000_0"
+    )
+
+    failed_objects_count = s3_tagger.tag_path(
+        ["data/db1/tab1/00000_0", "data/db2/tab2/missing_0"],
+        s3_client,
+        BUCKET_TO_TAG,
+        csv_data,
+    )
+
+    assert failed_objects_count == 1
+    s3_tagger.logger.error.assert_any_call(
+        'Failed to tag objects", "failed_objects_count": "1'
+    )
+
+
 @mock_s3
 def test_tag_path_no_objects_tagged(csv_data):
     objects_to_tag = ["data/db1/tab1/00000_0", "data/db2/tab2/00000_0"]